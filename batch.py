@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, TextIO, Tuple
+
+from calculate import Graph, RecipeSet, write_graph
+from planner_daemon import Query, parse_query, solve
+
+# A scenario file is a JSON list of objects with the same fields as the
+# requests of the planner daemon, plus an optional name for the output file:
+#   [{"name": "science", "targets": {"science": 1}, "expensive": false,
+#     "factories": {"furnace": [2, 1.2]}, "format": "svg"}]
+
+
+class Scenario:
+    def __init__(self, name: str, query: Query, format: str) -> None:
+        self.name = name
+        self.query = query
+        self.format = format
+
+
+def load_scenarios(recipes: RecipeSet, data: Any) -> List[Scenario]:
+    if not isinstance(data, list):
+        raise RuntimeError('Scenario file must contain a list')
+    scenarios = []
+    names = set()
+    for number, request in enumerate(data, 1):
+        if not isinstance(request, dict):
+            raise RuntimeError('Scenario {} is not an object'.format(number))
+        try:
+            query = parse_query(recipes, request)
+        except RuntimeError as e:
+            raise RuntimeError('Scenario {}: {}'.format(number, e))
+        name = str(request.get('name') or '-'.join(item for item, _ in query[0]))
+        name = re.sub(r'[^\w.-]+', '_', name)
+        if name in names:
+            name = '{}-{}'.format(name, number)
+        names.add(name)
+        scenarios.append(Scenario(name, query, str(request.get('format', 'svg'))))
+    return scenarios
+
+
+def _render(graph: Graph, path: str, format: str) -> float:
+    # Runs in a thread; most of the time is spent waiting for graphviz.
+    start = time.perf_counter()
+    output = open(path, 'w')
+    try:
+        with output:
+            write_graph(graph, output, format)
+    except BaseException:
+        # Only remove the file we created, so a failed open keeps its error.
+        os.unlink(path)
+        raise
+    return time.perf_counter() - start
+
+
+def render_all(
+        recipes: RecipeSet,
+        scenarios: Sequence[Scenario],
+        directory: str,
+        max_workers: Optional[int]=None,
+        progress: Optional[TextIO]=None) -> Dict[str, str]:
+    # Solves every scenario on the shared recipe set, which is fast once the
+    # unit costs are known, and runs up to max_workers graphviz processes at
+    # a time. Returns the output path of every scenario, or raises the first
+    # error after all renders have finished.
+    os.makedirs(directory, exist_ok=True)
+    graphs = []
+    for scenario in scenarios:
+        try:
+            graphs.append((scenario, solve(recipes, scenario.query)))
+        except RuntimeError as e:
+            raise RuntimeError('{}: {}'.format(scenario.name, e))
+    paths = {
+        scenario.name: os.path.join(directory, '{}.{}'.format(scenario.name, scenario.format))
+        for scenario in scenarios
+    }
+    workers = max_workers or os.cpu_count() or 1
+    errors: List[Tuple[str, Exception]] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_render, graph, paths[scenario.name], scenario.format): scenario
+            for scenario, graph in graphs
+        }
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            scenario = futures[future]
+            try:
+                seconds = future.result()
+            except (RuntimeError, OSError) as e:
+                errors.append((scenario.name, e))
+                message = 'failed: {}'.format(e)
+            else:
+                message = '{:.2f}s'.format(seconds)
+            if progress is not None:
+                progress.write('[{}/{}] {} {}\n'.format(
+                    done, len(futures), paths[scenario.name], message))
+                progress.flush()
+    if errors:
+        name, error = errors[0]
+        raise RuntimeError('{}: {}'.format(name, error))
+    return paths
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Solve and render a list of scenarios in parallel.')
+    parser.add_argument('scenarios', help='JSON file with the scenarios')
+    parser.add_argument(
+        '-d', '--directory', default='.', help='output directory (default: current directory)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, help='graphviz processes at a time (default: CPU count)')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', help='do not report progress')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        try:
+            with open(args.scenarios) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RuntimeError('Cannot read {}: {}'.format(args.scenarios, e))
+        scenarios = load_scenarios(recipes, data)
+        render_all(
+            recipes, scenarios, args.directory, args.jobs, None if args.quiet else sys.stderr)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from calculate import Graph, Product, RecipeSet, factories, products
+
+vanilla_targets = ('science', 'satellite', 'speed module 3')
+
+synthetic_factory_types = [
+    factory_type for factory_type in factories
+    if factory_type not in ('raw', 'mining drill')
+]
+
+
+def synthetic_recipes(
+        size: int,
+        depth: int,
+        fan_in: int,
+        sharing: float,
+        seed: int=0) -> Tuple[RecipeSet, str]:
+    # Layered recipe DAG with size items, of which the first layer are raw
+    # inputs mined by drills. Every other item takes fan_in inputs: with
+    # probability sharing from any lower layer, otherwise an item of the
+    # layer directly below, preferring items that have no consumer yet, so
+    # that sharing=0 gives the narrowest DAG (a tree where the layer sizes
+    # allow it). A final 'target' item consumes the top layer.
+    # Returns the recipes and the name of the target.
+    random_state = random.Random(seed)
+    layer_size = max(fan_in, (size - 1) // (depth + 1))
+    layers: List[List[str]] = []
+    new_products: Dict[str, Product] = {}
+    count = 0
+    for layer in range(depth + 1):
+        names = []
+        remaining = size - 1 - count
+        for _ in range(min(layer_size, remaining) if layer < depth else remaining):
+            names.append('item {}'.format(count))
+            count += 1
+        if not names:
+            break
+        layers.append(names)
+
+    for name in layers[0]:
+        new_products[name] = Product(
+            time=random_state.uniform(0.5, 2),
+            inputs={},
+            color='gray50',
+            factory_type='mining drill',
+            category='raw')
+
+    lower: List[str] = list(layers[0])
+    for below, names in zip(layers, layers[1:]):
+        unused = list(below)
+        random_state.shuffle(unused)
+        for name in names:
+            inputs: Dict[str, float] = {}
+            while len(inputs) < min(fan_in, len(below)):
+                if unused and random_state.random() >= sharing:
+                    input = unused.pop()
+                else:
+                    input = random_state.choice(lower if sharing else below)
+                inputs[input] = float(random_state.randint(1, 4))
+            new_products[name] = Product(
+                time=random_state.uniform(0.5, 10),
+                inputs=inputs,
+                color='gray50',
+                factory_type=random_state.choice(synthetic_factory_types))
+        lower.extend(names)
+
+    new_products['target'] = Product(
+        time=1,
+        inputs={name: 1.0 for name in layers[-1]},
+        color='black',
+        factory_type='assembling machine final')
+    return (RecipeSet(new_products, factories), 'target')
+
+
+class Case:
+    # One benchmark: a recipe set and the targets to add to a fresh Graph.
+    def __init__(
+            self,
+            name: str,
+            recipes_factory: Callable[[], RecipeSet],
+            targets: Dict[str, float],
+            oil_processing: bool,
+            render: bool) -> None:
+        self.name = name
+        self.recipes_factory = recipes_factory
+        self.targets = targets
+        self.oil_processing = oil_processing
+        self.render = render
+
+
+def default_cases(sizes: Sequence[int], render: bool) -> List[Case]:
+    # A new recipe set per run, so that its structure is built every time.
+    def default_recipes() -> RecipeSet:
+        return RecipeSet(products, factories)
+    cases = [
+        Case(target, default_recipes, {target: 1.0}, True, render)
+        for target in vanilla_targets
+    ]
+    for size in sizes:
+        for shape, sharing in (('tree', 0.0), ('dag', 0.5)):
+            def recipes(size: int=size, sharing: float=sharing) -> RecipeSet:
+                return synthetic_recipes(size, depth=12, fan_in=3, sharing=sharing)[0]
+            cases.append(Case(
+                'synthetic {} {}'.format(shape, size), recipes, {'target': 1.0}, False, False))
+    return cases
+
+
+def run_case(case: Case, timings: Optional[Dict[str, float]]=None) -> Graph:
+    # Runs every phase once, adding the time of each phase to timings.
+    def phase(name: str, function: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = function()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+        return result
+
+    recipes = case.recipes_factory()
+    phase('structure', lambda: recipes.structure(False))
+    graph: Graph = phase('graph', lambda: Graph(False, recipes))
+    if case.oil_processing:
+        phase('add_oil_processing', graph.add_oil_processing)
+    for item, rate in case.targets.items():
+        phase('add', lambda: graph.add(item, rate))
+    phase('dot_lines', lambda: ''.join(graph.dot_lines()))
+    if case.render:
+        phase('render', lambda: graph.render(io.StringIO(), 'svg'))
+    return graph
+
+
+def measure(case: Case, repeat: int) -> Dict[str, Any]:
+    # Wall time is the best of repeat runs, memory and call counts are
+    # measured in separate runs so that they don't distort the timings.
+    times: Dict[str, float] = {}
+    for _ in range(repeat):
+        timings: Dict[str, float] = {}
+        graph = run_case(case, timings)
+        for name, seconds in timings.items():
+            times[name] = min(times.get(name, seconds), seconds)
+    times['total'] = sum(times.values())
+
+    tracemalloc.start()
+    try:
+        run_case(case)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    profile = cProfile.Profile()
+    profile.runcall(run_case, case)
+    calls: Dict[str, int] = {}
+    module = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calculate.py')
+    for (filename, _, function), (primitive_calls, *_) in pstats.Stats(profile).stats.items():  # type: ignore[attr-defined]
+        if os.path.abspath(filename) == module:
+            calls[function] = calls.get(function, 0) + primitive_calls
+
+    return {
+        'items': len(graph.demand),
+        'nodes': len(graph.nodes),
+        'edges': len(graph.edges),
+        'times': times,
+        'peak_memory': peak_memory,
+        'calls': dict(sorted(calls.items())),
+    }
+
+
+def compare(
+        results: Dict[str, Any],
+        baseline: Dict[str, Any],
+        tolerance: float) -> List[str]:
+    # Phases that got slower than the baseline by more than the tolerance.
+    regressions = []
+    for name, result in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            continue
+        for phase, seconds in result['times'].items():
+            old_seconds = old['times'].get(phase)
+            # Ignore phases too short to measure reliably.
+            if old_seconds and max(seconds, old_seconds) > 1e-3 and \
+                    seconds > old_seconds * (1 + tolerance):
+                regressions.append('{}: {} {:.2f}x slower ({:.4f}s -> {:.4f}s)'.format(
+                    name, phase, seconds / old_seconds, old_seconds, seconds))
+        if result['peak_memory'] > old['peak_memory'] * (1 + tolerance):
+            regressions.append('{}: peak memory {:.2f}x larger'.format(
+                name, result['peak_memory'] / old['peak_memory']))
+    return regressions
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Measure Graph on vanilla targets and synthetic recipe DAGs.')
+    parser.add_argument(
+        '--sizes', default='100,1000,5000',
+        help='comma separated item counts of the synthetic recipes (default: 100,1000,5000)')
+    parser.add_argument(
+        '--repeat', type=int, default=5, help='runs per case, the best is kept (default: 5)')
+    parser.add_argument(
+        '--case', action='append', help='only run cases containing this text')
+    parser.add_argument(
+        '--no-render', action='store_true', help='skip running graphviz')
+    parser.add_argument(
+        '-o', '--output', help='save the results as a JSON baseline')
+    parser.add_argument(
+        '--baseline', help='compare with a saved JSON baseline, exit with 1 on regressions')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='allowed slowdown against the baseline (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    render = not args.no_render and shutil.which('dot') is not None
+    cases = default_cases([int(size) for size in args.sizes.split(',') if size], render)
+    if args.case:
+        cases = [case for case in cases if any(text in case.name for text in args.case)]
+
+    results: Dict[str, Any] = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': {},
+    }
+    for case in cases:
+        result = measure(case, args.repeat)
+        results['cases'][case.name] = result
+        print('{:<24} {:>5} items {:>9.2f} ms {:>9.1f} KiB peak {:>8} calls'.format(
+            case.name,
+            result['items'],
+            result['times']['total'] * 1000,
+            result['peak_memory'] / 1024,
+            sum(result['calls'].values())))
+        for phase, seconds in result['times'].items():
+            if phase != 'total':
+                print('    {:<20} {:>9.3f} ms'.format(phase, seconds * 1000))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: {}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
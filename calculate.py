@@ -1,26 +1,38 @@
 #!/usr/bin/env python3
-import graphviz
+from array import array
+import bisect
+import contextlib
 import copy
-from typing import Dict, Optional, Set, Tuple
+import math
+import os
+from types import MappingProxyType
+from typing import (
+    ContextManager, Dict, Generic, Iterable, Iterator, List, Mapping, Optional, Protocol, Sequence,
+    Set, TextIO, Tuple, TypeVar, Union)
 import sys
+import time
 
 
 class RenderProduct:
+    __slots__ = ('color', 'category')
+
     def __init__(self, color: str, category: Optional[str]=None):
         self.color = color
         self.category = category
 
 
 class Product(RenderProduct):
+    __slots__ = ('time', 'product', 'inputs', 'time_expensive', 'input_expensive', 'factory_type')
+
     def __init__(
             self,
             time: float,
-            inputs: Dict[str, int],
+            inputs: Dict[str, float],
             color: str,
             factory_type: str,
-            product: int=1,
+            product: float=1,
             time_expensive: Optional[float]=None,
-            input_expensive: Optional[Dict[str, int]]=None,
+            input_expensive: Optional[Dict[str, float]]=None,
             category: Optional[str]=None) -> None:
         super().__init__(color, category)
         self.time = time
@@ -32,6 +44,8 @@ class Product(RenderProduct):
 
 
 class Factory:
+    __slots__ = ('speed', 'productivity')
+
     def __init__(self, speed: float, productivity: float) -> None:
         self.speed = speed
         self.productivity = productivity
@@ -376,7 +390,6 @@ products: Dict[str, Product] = {
         color='khaki4',
         factory_type='assembling machine final'),
 
-    # TODO: implement oil processing
     'crude oil': Product(
         time=1,
         inputs={},
@@ -410,16 +423,17 @@ products: Dict[str, Product] = {
 }
 
 
-render_products: Dict[str, RenderProduct] = copy.copy(products)
-render_products['heavy oil cracking'] = RenderProduct(
-    color=products['heavy oil'].color,
-    category='oil processing')
-render_products['light oil cracking'] = RenderProduct(
-    color=products['light oil'].color,
-    category='oil processing')
-render_products['advanced oil processing'] = RenderProduct(
-    color='darkorange4',
-    category='oil processing')
+oil_processing_render_products: Dict[str, RenderProduct] = {
+    'heavy oil cracking': RenderProduct(
+        color=products['heavy oil'].color,
+        category='oil processing'),
+    'light oil cracking': RenderProduct(
+        color=products['light oil'].color,
+        category='oil processing'),
+    'advanced oil processing': RenderProduct(
+        color='darkorange4',
+        category='oil processing'),
+}
 
 
 factories: Dict[str, Factory] = {
@@ -435,7 +449,6 @@ factories: Dict[str, Factory] = {
     'mining drill': Factory(0.5, 1.0),
     # 2 prod. module + 1 speed module
     'chemical plant': Factory(1.2, 1.2),
-    # TODO: implement oil processing
     'raw': Factory(1.0, 1.0),
     # 4 prod. science packs
     'rocket silo': Factory(0.4, 1.4),
@@ -444,173 +457,1276 @@ factories: Dict[str, Factory] = {
 }
 
 
+N = TypeVar('N', bound='Scalar')
+
+
+class Scalar(Protocol):
+    # The arithmetic OilProcessing needs, so that it runs on plain floats
+    # and on the dual numbers of sensitivity.py alike.
+    def __add__(self: N, other: Union[N, float], /) -> N: ...
+    def __radd__(self: N, other: float, /) -> N: ...
+    def __sub__(self: N, other: Union[N, float], /) -> N: ...
+    def __rsub__(self: N, other: float, /) -> N: ...
+    def __mul__(self: N, other: Union[N, float], /) -> N: ...
+    def __rmul__(self: N, other: float, /) -> N: ...
+    def __truediv__(self: N, other: Union[N, float], /) -> N: ...
+    def __rtruediv__(self: N, other: float, /) -> N: ...
+    def __lt__(self: N, other: Union[N, float], /) -> bool: ...
+    def __gt__(self: N, other: Union[N, float], /) -> bool: ...
+
+
 def calculate_forward(
-        factory: Factory,
+        speed: N,
+        productivity: N,
         input_rate: float,
         factory_input: float,
         time: float,
-        outputs: Dict[str, float]) -> Tuple[float, Dict[str, float]]:
-    num_factories = input_rate * time / factory_input / factory.speed
+        outputs: Dict[str, float]) -> Tuple[N, Dict[str, N]]:
+    num_factories = input_rate * time / factory_input / speed
     output_rates = {
-        name: rate * factory.productivity * input_rate / factory_input
+        name: rate * productivity * input_rate / factory_input
         for name, rate in outputs.items()
     }
     return (num_factories, output_rates)
 
 
+def positive_part(value: N) -> N:
+    return value if value > 0.0 else value - value
+
+
+oil_products = ('heavy oil', 'light oil', 'petroleum gas')
+# Oil refinery uses the same modules
+oil_processing_factory = 'chemical plant'
+
+
+class OilRecipe:
+    # One step of oil processing: time and the amounts of its single input
+    # and its outputs per craft.
+    __slots__ = ('time', 'input', 'amount', 'outputs')
+
+    def __init__(self, time: float, input: str, amount: float, outputs: Dict[str, float]) -> None:
+        self.time = time
+        self.input = input
+        self.amount = amount
+        self.outputs = outputs
+
+
+oil_recipes: Dict[str, OilRecipe] = {
+    'advanced oil processing': OilRecipe(
+        time=5,
+        input='crude oil',
+        amount=100,
+        outputs={'heavy oil': 25, 'light oil': 45, 'petroleum gas': 55}),
+    'heavy oil cracking': OilRecipe(
+        time=2,
+        input='heavy oil',
+        amount=40,
+        outputs={'light oil': 30}),
+    'light oil cracking': OilRecipe(
+        time=2,
+        input='light oil',
+        amount=30,
+        outputs={'petroleum gas': 20}),
+}
+
+
+class OilProcessing(Generic[N]):
+    # Advanced oil processing with heavy and light oil cracking. The
+    # coefficients are per unit of input of each step and only depend on the
+    # factory, so balancing any oil demand is constant work.
+    def __init__(self, speed: N, productivity: N) -> None:
+        self.refinery, refinery_outputs = self._forward(
+            speed, productivity, oil_recipes['advanced oil processing'])
+        self.heavy_oil = refinery_outputs['heavy oil']
+        self.light_oil = refinery_outputs['light oil']
+        self.petroleum_gas = refinery_outputs['petroleum gas']
+        self.heavy_oil_cracking, light_oil = self._forward(
+            speed, productivity, oil_recipes['heavy oil cracking'])
+        self.heavy_to_light = light_oil['light oil']
+        self.light_oil_cracking, petroleum_gas = self._forward(
+            speed, productivity, oil_recipes['light oil cracking'])
+        self.light_to_gas = petroleum_gas['petroleum gas']
+
+        # Crude oil needed per unit of demand when everything that is not
+        # needed as heavy (light) oil is cracked further.
+        self.light_yield = self.light_oil + self.heavy_to_light * self.heavy_oil
+        self.gas_yield = self.petroleum_gas + self.light_to_gas * self.light_yield
+
+    @staticmethod
+    def for_factory(factory: Factory) -> 'OilProcessing[float]':
+        return OilProcessing(factory.speed, factory.productivity)
+
+    @staticmethod
+    def _forward(speed: N, productivity: N, recipe: OilRecipe) -> Tuple[N, Dict[str, N]]:
+        return calculate_forward(
+            speed,
+            productivity,
+            input_rate=1.0,
+            factory_input=recipe.amount,
+            time=recipe.time,
+            outputs=recipe.outputs)
+
+    def solve(
+            self,
+            heavy_oil: N,
+            light_oil: N,
+            petroleum_gas: N) -> Tuple[N, N, N]:
+        # Returns the crude oil input and the heavy and light oil that is
+        # cracked. Whichever product needs the most crude oil determines the
+        # refinery rate; any surplus of the others is cracked only as far as
+        # needed.
+        crude_oil = max(
+            heavy_oil / self.heavy_oil,
+            (light_oil + self.heavy_to_light * heavy_oil) / self.light_yield,
+            (petroleum_gas + self.light_to_gas * (light_oil + self.heavy_to_light * heavy_oil)) /
+            self.gas_yield)
+        light_cracked = positive_part(
+            (petroleum_gas - self.petroleum_gas * crude_oil) / self.light_to_gas)
+        heavy_cracked = positive_part(
+            (light_oil + light_cracked - self.light_oil * crude_oil) / self.heavy_to_light)
+        return (crude_oil, heavy_cracked, light_cracked)
+
+    def balance(
+            self,
+            heavy_oil: N,
+            light_oil: N,
+            petroleum_gas: N) -> Tuple[Dict[str, N], Dict[Tuple[str, str], N]]:
+        crude_oil, heavy_cracked, light_cracked = self.solve(heavy_oil, light_oil, petroleum_gas)
+        nodes = {
+            'crude oil': crude_oil,
+            'advanced oil processing': self.refinery * crude_oil,
+            'heavy oil cracking': self.heavy_oil_cracking * heavy_cracked,
+            'light oil cracking': self.light_oil_cracking * light_cracked,
+        }
+        # Light oil from the refinery is cracked first.
+        refinery_light_cracked = min(light_cracked, self.light_oil * crude_oil)
+        cracked_light = self.heavy_to_light * heavy_cracked
+        # Only cracked products are balanced exactly. A surplus of the others
+        # is left in the refinery, so every edge ends at a node of the graph.
+        edges = {
+            ('crude oil', 'advanced oil processing'): crude_oil,
+            ('advanced oil processing', 'heavy oil'):
+                min(self.heavy_oil * crude_oil - heavy_cracked, heavy_oil),
+            ('advanced oil processing', 'heavy oil cracking'): heavy_cracked,
+            ('advanced oil processing', 'light oil'):
+                min(self.light_oil * crude_oil - refinery_light_cracked, light_oil),
+            ('advanced oil processing', 'light oil cracking'): refinery_light_cracked,
+            ('advanced oil processing', 'petroleum gas'):
+                min(self.petroleum_gas * crude_oil, petroleum_gas),
+            ('heavy oil cracking', 'light oil'):
+                cracked_light - (light_cracked - refinery_light_cracked),
+            ('heavy oil cracking', 'light oil cracking'): light_cracked - refinery_light_cracked,
+            ('light oil cracking', 'petroleum gas'): self.light_to_gas * light_cracked,
+        }
+        return (
+            {name: rate for name, rate in nodes.items() if rate > 1e-12},
+            {edge: rate for edge, rate in edges.items() if rate > 1e-12})
+
+
+def get_recipe(product: Product, expensive: bool) -> Tuple[float, Dict[str, float]]:
+    time = product.time_expensive if expensive and product.time_expensive is not None else product.time
+    inputs = product.input_expensive if expensive and product.input_expensive is not None else product.inputs
+    return (time, inputs)
+
+
+def find_components(products: Mapping[str, Product], expensive: bool) -> List[List[str]]:
+    # Strongly connected components of the recipe graph (Tarjan's algorithm).
+    # Every component comes before the components of its inputs, so demand
+    # can be pushed down the recipe tree in a single pass. Components with
+    # more than one product, or a product that consumes itself, are recipe
+    # cycles that have to be solved together.
+    index: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    components: List[List[str]] = []
+
+    def visit(name: str) -> Tuple[str, Iterator[str]]:
+        index[name] = lowlink[name] = len(index)
+        stack.append(name)
+        on_stack.add(name)
+        return (name, iter(get_recipe(products[name], expensive)[1]))
+
+    for root in products:
+        if root in index:
+            continue
+        work = [visit(root)]
+        while work:
+            name, inputs = work[-1]
+            for input in inputs:
+                if input not in index:
+                    work.append(visit(input))
+                    break
+                if input in on_stack:
+                    lowlink[name] = min(lowlink[name], index[input])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] == index[name]:
+                    component: List[str] = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == name:
+                            break
+                    components.append(component)
+
+    components.reverse()
+    return components
+
+
+def is_cycle(products: Mapping[str, Product], component: List[str], expensive: bool) -> bool:
+    return len(component) > 1 or \
+        component[0] in get_recipe(products[component[0]], expensive)[1]
+
+
+def solve_linear_system(matrix: List[List[float]], vector: List[float]) -> List[float]:
+    # Gaussian elimination with partial pivoting. Only used for the small
+    # systems of recipe cycles.
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            raise RuntimeError('Singular system')
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(column + 1, size):
+            factor = rows[row][column] / rows[column][column]
+            if factor != 0.0:
+                for k in range(column, size + 1):
+                    rows[row][k] -= factor * rows[column][k]
+    result = [0.0] * size
+    for row in reversed(range(size)):
+        value = rows[row][size] - sum(
+            rows[row][k] * result[k] for k in range(row + 1, size))
+        result[row] = value / rows[row][row]
+    return result
+
+
+def cycle_matrix(
+        products: Mapping[str, Product],
+        factories: Mapping[str, Factory],
+        component: List[str],
+        expensive: bool) -> List[List[float]]:
+    # I - A, where A[i][j] is the amount of component[i] consumed per unit of
+    # component[j] produced.
+    matrix = [[1.0 if i == j else 0.0 for j in range(len(component))]
+              for i in range(len(component))]
+    position = {name: i for i, name in enumerate(component)}
+    for j, name in enumerate(component):
+        product = products[name]
+        factory = factories[product.factory_type]
+        for input, amount in get_recipe(product, expensive)[1].items():
+            if input in position:
+                matrix[position[input]][j] -= amount / factory.productivity / product.product
+    return matrix
+
+
+# Common names that are not prefixes of the product name.
+product_aliases: Dict[str, str] = {
+    'green circuit': 'electronic circuit',
+    'red circuit': 'advanced circuit',
+    'blue circuit': 'processing unit',
+    'copper cable': 'copper wire',
+    'gear': 'iron gear wheel',
+    'lds': 'low density structure',
+    'rcu': 'rocket control unit',
+    'red science': 'science pack 1 red',
+    'green science': 'science pack 2 green',
+    'black science': 'science pack 3 black',
+    'military science': 'science pack 3 black',
+    'blue science': 'science pack 4 blue',
+    'purple science': 'science pack 5 purple',
+    'production science': 'science pack 5 purple',
+    'yellow science': 'science pack 6 yellow',
+    'utility science': 'science pack 6 yellow',
+    'white science': 'science pack 7 white',
+    'space science': 'science pack 7 white',
+}
+
+
+def normalize_name(name: str) -> str:
+    return ' '.join(name.lower().replace('-', ' ').replace('_', ' ').split())
+
+
+class ProductIndex:
+    # Sorted normalized names, so that all names with a given prefix form a
+    # contiguous range that can be found by bisection.
+    def __init__(self, names: Iterable[str]) -> None:
+        entries = sorted((normalize_name(name), name) for name in names)
+        self.size = len(entries)
+        self.products = {name for _, name in entries}
+        self.keys = [key for key, _ in entries]
+        self.names = [name for _, name in entries]
+        self.exact = dict(entries)
+        self.aliases = {
+            normalize_name(alias): name
+            for alias, name in product_aliases.items()
+            if name in self.names
+        }
+
+    def find(self, item: str) -> str:
+        if item in self.products:
+            return item
+        key = normalize_name(item)
+        if key in self.exact:
+            return self.exact[key]
+        if key in self.aliases:
+            return self.aliases[key]
+
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_left(self.keys, key + '\U0010ffff', start)
+        if end - start == 1:
+            return self.names[start]
+        if end - start > 1:
+            raise RuntimeError('Ambiguous item: {} (candidates: {})'.format(
+                item, ', '.join(self.names[start:end])))
+
+        import difflib
+        matches = difflib.get_close_matches(key, self.keys + list(self.aliases), n=5, cutoff=0.8)
+        if len(matches) == 1:
+            return self.exact.get(matches[0]) or self.aliases[matches[0]]
+        if matches:
+            raise RuntimeError('Item not found: {} (did you mean: {})'.format(
+                item, ', '.join(self.exact.get(match) or self.aliases[match] for match in matches)))
+        raise RuntimeError('Item not found: {}'.format(item))
+
+
+class RecipeStructure:
+    # Everything that only depends on the inputs of the recipes, shared by
+    # all overlays of a recipe set. Products are numbered in the order of
+    # their components, and the recipe edges are stored in compressed sparse
+    # row form both by consumer and by input.
+    def __init__(self, products: Mapping[str, Product], expensive: bool) -> None:
+        self.components = find_components(products, expensive)
+        self.cycles = [is_cycle(products, component, expensive) for component in self.components]
+        self.names = [name for component in self.components for name in component]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.component_ids = [[self.ids[name] for name in component] for component in self.components]
+        self.component_of = array('l', bytes(array('l').itemsize * len(self.names)))
+        for c, component_ids in enumerate(self.component_ids):
+            for i in component_ids:
+                self.component_of[i] = c
+
+        # Inputs of product i are edge_input[edge_start[i]:edge_start[i + 1]].
+        self.edge_start = array('l', [0])
+        self.edge_input = array('l')
+        self.edge_consumer = array('l')
+        self.edge_amount = array('d')
+        for i, name in enumerate(self.names):
+            for input, amount in get_recipe(products[name], expensive)[1].items():
+                self.edge_input.append(self.ids[input])
+                self.edge_consumer.append(i)
+                self.edge_amount.append(amount)
+            self.edge_start.append(len(self.edge_input))
+        self.edge_index = {
+            (self.names[self.edge_input[k]], self.names[self.edge_consumer[k]]): k
+            for k in range(len(self.edge_input))
+        }
+
+        # Edges consuming product i are consumer_edge[consumer_start[i]:consumer_start[i + 1]].
+        counts = [0] * (len(self.names) + 1)
+        for k in self.edge_input:
+            counts[k + 1] += 1
+        for i in range(len(self.names)):
+            counts[i + 1] += counts[i]
+        self.consumer_start = array('l', counts)
+        self.consumer_edge = array('l', bytes(array('l').itemsize * len(self.edge_input)))
+        position = list(counts)
+        for k, i in enumerate(self.edge_input):
+            self.consumer_edge[position[i]] = k
+            position[i] += 1
+
+
+class UnitCost:
+    # Everything needed for one unit per second of a product, as sparse
+    # vectors over the ids of a RecipeStructure: the demand and buildings of
+    # every product involved (ids in ascending order) and the edge rates.
+    __slots__ = ('ids', 'demand', 'buildings', 'edges', 'edge_rates', 'oil')
+
+    def __init__(
+            self,
+            ids: 'array[int]',
+            demand: 'array[float]',
+            buildings: 'array[float]',
+            edges: 'array[int]',
+            edge_rates: 'array[float]',
+            oil: bool) -> None:
+        self.ids = ids
+        self.demand = demand
+        self.buildings = buildings
+        self.edges = edges
+        self.edge_rates = edge_rates
+        self.oil = oil
+
+
+class UnitCosts:
+    # Per-unit costs of the products for one recipe set and recipe variant.
+    # The cost of a product is computed the first time it is added (or for
+    # all of them by build()) and shared by every graph of the recipe set, so
+    # adding it again is a scaled addition of its vectors instead of a
+    # traversal of the recipe tree.
+    def __init__(self, recipes: 'RecipeSet', expensive: bool) -> None:
+        self.recipes = recipes
+        self.expensive = expensive
+        self.structure = recipes.structure(expensive)
+        self.costs: Dict[int, UnitCost] = {}
+        self.inverses: Dict[int, List[List[float]]] = {}
+
+        size = len(self.structure.names)
+        self.building_factor = array('d', bytes(8 * size))
+        self.input_factor = array('d', bytes(8 * size))
+        for i, name in enumerate(self.structure.names):
+            product = recipes.products[name]
+            factory = recipes.factories[product.factory_type]
+            time = get_recipe(product, expensive)[0]
+            self.building_factor[i] = time / factory.speed / factory.productivity / product.product
+            self.input_factor[i] = 1.0 / factory.productivity / product.product
+
+    def cost(self, i: int) -> UnitCost:
+        cost = self.costs.get(i)
+        if cost is None:
+            cost = self._compute(i)
+            self.costs[i] = cost
+        return cost
+
+    def build(self) -> None:
+        for i in range(len(self.structure.names)):
+            self.cost(i)
+
+    def _inverse(self, c: int) -> List[List[float]]:
+        # Columns of (I - A)^-1 for a recipe cycle: the rates of the cycle
+        # members per unit of net output of each of them.
+        inverse = self.inverses.get(c)
+        if inverse is None:
+            component = self.structure.components[c]
+            matrix = cycle_matrix(
+                self.recipes.products, self.recipes.factories, component, self.expensive)
+            try:
+                inverse = [
+                    solve_linear_system(matrix, [1.0 if j == m else 0.0 for m in range(len(component))])
+                    for j in range(len(component))
+                ]
+            except RuntimeError:
+                inverse = []
+            if not inverse or any(not rate >= -1e-9 for rates in inverse for rate in rates):
+                raise RuntimeError('Recipe cycle has no net output: {}'.format(
+                    ', '.join(component)))
+            self.inverses[c] = inverse
+        return inverse
+
+    def _compute(self, source: int) -> UnitCost:
+        # The same propagation as Graph._add used to do for every target,
+        # for one unit of output.
+        structure = self.structure
+        component_of = structure.component_of
+        pending = {source: 1.0}
+        demand: Dict[int, float] = {}
+        edges: Dict[int, float] = {}
+        for c in range(component_of[source], len(structure.component_ids)):
+            component = structure.component_ids[c]
+            if not any(i in pending for i in component):
+                continue
+            rates = [pending.pop(i, 0.0) for i in component]
+            if structure.cycles[c]:
+                inverse = self._inverse(c)
+                rates = [
+                    sum(column[m] * rate for column, rate in zip(inverse, rates))
+                    for m in range(len(component))
+                ]
+
+            for i, rate in zip(component, rates):
+                demand[i] = rate
+                input_rate = rate * self.input_factor[i]
+                for k in range(structure.edge_start[i], structure.edge_start[i + 1]):
+                    edge_rate = input_rate * structure.edge_amount[k]
+                    edges[k] = edge_rate
+                    input = structure.edge_input[k]
+                    if component_of[input] != c:
+                        pending[input] = pending.get(input, 0.0) + edge_rate
+            if not pending:
+                break
+
+        return UnitCost(
+            array('l', demand),
+            array('d', demand.values()),
+            array('d', [rate * self.building_factor[i] for i, rate in demand.items()]),
+            array('l', edges),
+            array('d', edges.values()),
+            any(structure.names[i] in oil_products for i in demand))
+
+    def raw(self, item: str) -> Dict[str, float]:
+        # Raw inputs per unit of the item.
+        cost = self.cost(self.structure.ids[item])
+        names = self.structure.names
+        return {
+            names[j]: amount for j, amount in zip(cost.ids, cost.demand)
+            if self.structure.edge_start[j] == self.structure.edge_start[j + 1]
+        }
+
+    def factory_buildings(self, item: str) -> Dict[str, float]:
+        # Buildings per factory type per unit of the item.
+        cost = self.cost(self.structure.ids[item])
+        result: Dict[str, float] = {}
+        for j, buildings in zip(cost.ids, cost.buildings):
+            factory_type = self.recipes.products[self.structure.names[j]].factory_type
+            result[factory_type] = result.get(factory_type, 0.0) + buildings
+        return result
+
+
+class RecipeSet:
+    # Read-only products and factories. Changes are made with overlay(), which
+    # creates a new set that shares everything that did not change, so any
+    # number of graphs can be evaluated at the same time without affecting
+    # each other. The Product and Factory objects must not be modified.
+    def __init__(
+            self,
+            products: Mapping[str, Product],
+            factories: Mapping[str, Factory],
+            structures: Optional[Dict[bool, RecipeStructure]]=None,
+            unit_costs: Optional[Dict[bool, UnitCosts]]=None) -> None:
+        self.products: Mapping[str, Product] = MappingProxyType(dict(products))
+        self.factories: Mapping[str, Factory] = MappingProxyType(dict(factories))
+        self.render_products: Mapping[str, RenderProduct] = MappingProxyType(
+            {**self.products, **oil_processing_render_products})
+        self.structures: Dict[bool, RecipeStructure] = {} if structures is None else structures
+        self.unit_costs: Dict[bool, UnitCosts] = {} if unit_costs is None else unit_costs
+        self.index: Optional[ProductIndex] = None
+
+    def __reduce__(self) -> Tuple[type, Tuple[Dict[str, Product], Dict[str, Factory]]]:
+        return (RecipeSet, (dict(self.products), dict(self.factories)))
+
+    def structure(self, expensive: bool) -> RecipeStructure:
+        structure = self.structures.get(expensive)
+        if structure is None:
+            structure = RecipeStructure(self.products, expensive)
+            self.structures[expensive] = structure
+        return structure
+
+    def costs(self, expensive: bool) -> UnitCosts:
+        costs = self.unit_costs.get(expensive)
+        if costs is None:
+            costs = UnitCosts(self, expensive)
+            self.unit_costs[expensive] = costs
+        return costs
+
+    def find_product(self, item: str) -> str:
+        if item in self.products:
+            return item
+        if self.index is None:
+            self.index = ProductIndex(self.products)
+        return self.index.find(item)
+
+    def overlay(
+            self,
+            factories: Optional[Mapping[str, Factory]]=None,
+            factory_types: Optional[Mapping[str, str]]=None,
+            categories: Optional[Mapping[str, Optional[str]]]=None) -> 'RecipeSet':
+        changed: Dict[str, Product] = {}
+        for name, factory_type in (factory_types or {}).items():
+            product = changed.get(name) or copy.copy(self.products[name])
+            product.factory_type = factory_type
+            changed[name] = product
+        for name, category in (categories or {}).items():
+            product = changed.get(name) or copy.copy(self.products[name])
+            product.category = category
+            changed[name] = product
+        # Categories only matter for rendering, so the costs stay valid.
+        return RecipeSet(
+            {**self.products, **changed},
+            {**self.factories, **(factories or {})},
+            self.structures,
+            self.unit_costs if not factories and not factory_types else None)
+
+
+default_recipe_set: Optional[RecipeSet] = None
+
+
+def default_recipes() -> RecipeSet:
+    # Shared by every caller, so the structures and unit costs of the
+    # default recipes are only computed once per process.
+    global default_recipe_set
+    if default_recipe_set is None:
+        default_recipe_set = RecipeSet(products, factories)
+    return default_recipe_set
+
+
+class NodeView(Mapping[str, float]):
+    # Buildings per node, read from the arrays of a Graph.
+    def __init__(self, graph: 'Graph') -> None:
+        self.graph = graph
+
+    def __getitem__(self, name: str) -> float:
+        graph = self.graph
+        if name == 'end':
+            return 0.0
+        i = graph.structure.ids.get(name)
+        if i is not None and i in graph.node_rates:
+            return graph.node_rates[i] + graph.oil_nodes.get(name, 0.0)
+        return graph.oil_nodes[name]
+
+    def __iter__(self) -> Iterator[str]:
+        graph = self.graph
+        names = graph.structure.names
+        yield 'end'
+        for i in graph.node_rates:
+            yield names[i]
+        for name in graph.oil_nodes:
+            j = graph.structure.ids.get(name)
+            if j is None or j not in graph.node_rates:
+                yield name
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class EdgeView(Mapping[Tuple[str, str], float]):
+    # Rate per edge, read from the arrays of a Graph.
+    def __init__(self, graph: 'Graph') -> None:
+        self.graph = graph
+
+    def __getitem__(self, edge: Tuple[str, str]) -> float:
+        graph = self.graph
+        source, target = edge
+        if target == 'end':
+            return graph.end_rates[graph.structure.ids[source]]
+        if edge in graph.oil_edges:
+            return graph.oil_edges[edge]
+        k = graph.structure.edge_index[edge]
+        if graph.structure.edge_consumer[k] not in graph.demand_rates:
+            raise KeyError(edge)
+        return graph.edge_rates.get(k, 0.0)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        graph = self.graph
+        structure = graph.structure
+        names = structure.names
+        for i in graph.end_rates:
+            yield (names[i], 'end')
+        for i in graph.demand_rates:
+            for k in range(structure.edge_start[i], structure.edge_start[i + 1]):
+                yield (names[structure.edge_input[k]], names[i])
+        yield from graph.oil_edges
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class DemandView(Mapping[str, float]):
+    # Total output rate of every product in a Graph.
+    def __init__(self, graph: 'Graph') -> None:
+        self.graph = graph
+
+    def __getitem__(self, name: str) -> float:
+        i = self.graph.structure.ids.get(name)
+        if i is None or i not in self.graph.demand_rates:
+            raise KeyError(name)
+        return self.graph.demand_rates[i]
+
+    def __iter__(self) -> Iterator[str]:
+        names = self.graph.structure.names
+        return (names[i] for i in self.graph.demand_rates)
+
+    def __len__(self) -> int:
+        return len(self.graph.demand_rates)
+
+
+class Profile:
+    # Opt-in instrumentation of a Graph: the time spent in every phase and
+    # how often every product was expanded. Phase times exclude the time of
+    # phases nested in them, so they add up to the total.
+    def __init__(self) -> None:
+        self.times: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.expansions: Dict[str, int] = {}
+        self._nested: List[float] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str, count: bool=True) -> Iterator[None]:
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.times[name] = self.times.get(name, 0.0) + elapsed - nested
+            if count:
+                self.calls[name] = self.calls.get(name, 0) + 1
+
+    def lines(self, name: str, lines: Iterable[str]) -> Iterator[str]:
+        # Times the generation of streamed lines, excluding their consumer.
+        self.calls[name] = self.calls.get(name, 0) + 1
+        iterator = iter(lines)
+        while True:
+            with self.phase(name, count=False):
+                line = next(iterator, None)
+            if line is None:
+                return
+            yield line
+
+    def expanded(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.expansions[name] = self.expansions.get(name, 0) + 1
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'phases': {
+                name: {'time': self.times[name], 'calls': self.calls.get(name, 0)}
+                for name in self.times
+            },
+            'expansions': dict(sorted(
+                self.expansions.items(), key=lambda item: (-item[1], item[0]))),
+        }
+
+    def write(self, output: TextIO, limit: int=20) -> None:
+        output.write('{:<20} {:>10} {:>8}\n'.format('phase', 'ms', 'calls'))
+        for name, time_spent in sorted(self.times.items(), key=lambda item: -item[1]):
+            output.write('{:<20} {:>10.3f} {:>8}\n'.format(
+                name, time_spent * 1000, self.calls.get(name, 0)))
+        output.write('{:<20} {:>10.3f}\n'.format('total', sum(self.times.values()) * 1000))
+        if self.expansions:
+            output.write('\n{:<40} {:>8}\n'.format('product', 'expanded'))
+            expansions = sorted(self.expansions.items(), key=lambda item: (-item[1], item[0]))
+            for name, count in expansions[:limit]:
+                output.write('{:<40} {:>8}\n'.format(name, count))
+
+
 class Graph:
-    def __init__(self, expensive: bool) -> None:
+    # Rates are kept in dicts keyed by the product and edge ids of the
+    # recipe structure, holding only the products the targets need, so a
+    # Graph costs nothing per product of the recipe set. Nodes, edges and
+    # demand are read-only views of them.
+    def __init__(
+            self,
+            expensive: bool,
+            recipes: Optional[RecipeSet]=None,
+            profile: Optional[Profile]=None) -> None:
         self.expensive = expensive
-        self.nodes: Dict[str, float] = {'end': 0.0}
-        self.edges: Dict[Tuple[str, str], float] = {}
+        self.recipes = default_recipes() if recipes is None else recipes
+        self.profile = profile
+        self.structure = self.recipes.structure(expensive)
         self.targets: Set[str] = set()
+        # The keys of demand_rates and node_rates are the products present.
+        self.demand_rates: Dict[int, float] = {}
+        self.node_rates: Dict[int, float] = {}
+        self.edge_rates: Dict[int, float] = {}
+        self.end_rates: Dict[int, float] = {}
+        self.nodes = NodeView(self)
+        self.edges = EdgeView(self)
+        self.demand = DemandView(self)
 
-    def _add(self, source: str, target: str, rate: float) -> None:
-        product = products[source]
-        factory = factories[product.factory_type]
+        # Buildings per unit of output and input multiplier per unit of
+        # output, which depend on the factory of the product, and the
+        # products of every factory type, so that a factory change only
+        # touches the products that use it. Only needed once factories are
+        # changed, see _prepare_updates.
+        self.building_factor: 'array[float]' = array('d')
+        self.input_factor: 'array[float]' = array('d')
+        self.factory_products: Optional[Dict[str, Set[int]]] = None
+
+        self.oil_processing: Optional[OilProcessing[float]] = None
+        self.oil_nodes: Dict[str, float] = {}
+        self.oil_edges: Dict[Tuple[str, str], float] = {}
+
+    def _phase(self, name: str) -> ContextManager[None]:
+        if self.profile is None:
+            return contextlib.nullcontext()
+        return self.profile.phase(name)
+
+    def _update_factors(self, i: int) -> None:
+        product = self.recipes.products[self.structure.names[i]]
+        factory = self.recipes.factories[product.factory_type]
+        time = get_recipe(product, self.expensive)[0]
+        self.building_factor[i] = time / factory.speed / factory.productivity / product.product
+        self.input_factor[i] = 1.0 / factory.productivity / product.product
+
+    def _solve_cycle(self, c: int, rates: List[float]) -> List[float]:
+        component = self.structure.components[c]
+        try:
+            result = solve_linear_system(cycle_matrix(
+                self.recipes.products, self.recipes.factories, component, self.expensive), rates)
+        except RuntimeError:
+            result = []
+        if not result or any(not rate >= -1e-9 for rate in result):
+            raise RuntimeError('Recipe cycle has no net output: {}'.format(
+                ', '.join(component)))
+        return result
+
+    def _prepare_updates(self) -> Dict[str, Set[int]]:
+        if self.factory_products is None:
+            costs = self.recipes.costs(self.expensive)
+            self.building_factor = array('d', costs.building_factor)
+            self.input_factor = array('d', costs.input_factor)
+            self.factory_products = {}
+            for i, name in enumerate(self.structure.names):
+                self.factory_products.setdefault(
+                    self.recipes.products[name].factory_type, set()).add(i)
+        return self.factory_products
+
+    def _add(self, source: int, rate: float) -> None:
+        cost = self.recipes.costs(self.expensive).cost(source)
+        demand_rates = self.demand_rates
+        node_rates = self.node_rates
+        edge_rates = self.edge_rates
+        for i, demand, buildings in zip(cost.ids, cost.demand, cost.buildings):
+            demand_rates[i] = demand_rates.get(i, 0.0) + rate * demand
+            node_rates[i] = node_rates.get(i, 0.0) + rate * buildings
+        for k, edge_rate in zip(cost.edges, cost.edge_rates):
+            edge_rates[k] = edge_rates.get(k, 0.0) + rate * edge_rate
+        if self.profile is not None:
+            self.profile.expanded(self.structure.names[i] for i in cost.ids)
 
-        time = product.time_expensive if self.expensive and product.time_expensive is not None else product.time
-        inputs = product.input_expensive if self.expensive and product.input_expensive is not None else product.inputs
+        if cost.oil and self.oil_processing is not None:
+            self._balance_oil()
 
-        self.nodes.setdefault(source, 0.0)
-        self.nodes[source] += rate * time / factory.speed / factory.productivity / product.product
-        self.edges.setdefault((source, target), 0.0)
-        self.edges[(source, target)] += rate
+    def _recompute(self, ids: Iterable[int]) -> None:
+        # Recalculate the given products and everything they consume, pulling
+        # the demand of each product from its consumers. Consumers outside of
+        # the recalculated part are unchanged, and the ones inside come
+        # earlier in the order.
+        structure = self.structure
+        dirty = {i for i in ids if i in self.demand_rates}
+        stack = list(dirty)
+        while stack:
+            i = stack.pop()
+            for k in range(structure.edge_start[i], structure.edge_start[i + 1]):
+                input = structure.edge_input[k]
+                if input not in dirty:
+                    dirty.add(input)
+                    stack.append(input)
 
-        for input, amount in inputs.items():
-            self._add(input, source, rate * amount / factory.productivity / product.product)
+        for c in sorted({structure.component_of[i] for i in dirty}):
+            component = structure.component_ids[c]
+            rates = []
+            for i in component:
+                rate = self.end_rates.get(i, 0.0)
+                for k in structure.consumer_edge[
+                        structure.consumer_start[i]:structure.consumer_start[i + 1]]:
+                    if structure.component_of[structure.edge_consumer[k]] != c:
+                        rate += self.edge_rates.get(k, 0.0)
+                rates.append(rate)
+            if structure.cycles[c]:
+                rates = self._solve_cycle(c, rates)
+            if self.profile is not None:
+                self.profile.expanded(structure.names[i] for i in component)
+
+            for i, rate in zip(component, rates):
+                self.demand_rates[i] = rate
+                self.node_rates[i] = rate * self.building_factor[i]
+                input_rate = rate * self.input_factor[i]
+                for k in range(structure.edge_start[i], structure.edge_start[i + 1]):
+                    self.edge_rates[k] = input_rate * structure.edge_amount[k]
+
+        if self.oil_processing is not None and \
+                any(structure.names[i] in oil_products for i in dirty):
+            self._balance_oil()
+
+    def _update_products(self, names: Iterable[str]) -> None:
+        factory_products = self._prepare_updates()
+        ids = [self.structure.ids[name] for name in names]
+        for i in ids:
+            for products in factory_products.values():
+                products.discard(i)
+            factory_type = self.recipes.products[self.structure.names[i]].factory_type
+            factory_products.setdefault(factory_type, set()).add(i)
+            self._update_factors(i)
+        with self._phase('recompute'):
+            self._recompute(ids)
+
+    def _update_factory(self, factory_type: str) -> None:
+        ids = self._prepare_updates().get(factory_type, set())
+        for i in ids:
+            self._update_factors(i)
+        with self._phase('recompute'):
+            self._recompute(ids)
+        if self.oil_processing is not None and factory_type == oil_processing_factory:
+            self.oil_processing = OilProcessing.for_factory(
+                self.recipes.factories[oil_processing_factory])
+            self._balance_oil()
+
+    def set_factory(self, factory_type: str, factory: Factory) -> None:
+        # The copies are taken from the recipes the rates were computed with.
+        self._prepare_updates()
+        self.recipes = self.recipes.overlay(factories={factory_type: factory})
+        self._update_factory(factory_type)
+
+    def set_factory_types(self, factory_types: Mapping[str, str]) -> None:
+        self._prepare_updates()
+        self.recipes = self.recipes.overlay(factory_types=factory_types)
+        self._update_products(factory_types)
+
+    def set_factory_type(self, item: str, factory_type: str) -> None:
+        self.set_factory_types({self.recipes.find_product(item): factory_type})
+
+    def _balance_oil(self) -> None:
+        assert self.oil_processing is not None
+        # The oil processing part only depends on the total oil demand, so
+        # the previous balance is replaced instead of being added to.
+        with self._phase('oil'):
+            self.oil_nodes, self.oil_edges = self.oil_processing.balance(
+                self.demand.get('heavy oil', 0.0),
+                self.demand.get('light oil', 0.0),
+                self.demand.get('petroleum gas', 0.0))
 
     def add(self, item: str, rate: float) -> None:
-        if item not in products:
-            for name in products.keys():
-                if name.startswith(item):
-                    item = name
-                    break
-            else:
-                raise RuntimeError('Item not found: {}'.format(item))
+        with self._phase('resolve'):
+            item = self.recipes.find_product(item)
         self.targets.add(item)
-        self._add(item, 'end', rate)
+        i = self.structure.ids[item]
+        self.end_rates[i] = self.end_rates.get(i, 0.0) + rate
+        with self._phase('expand'):
+            self._add(i, rate)
 
     def add_oil_processing(self) -> None:
-        if 'heavy oil' in self.nodes or 'light oil' in self.nodes:
-            raise RuntimeError('Only petroleum gas is supported')
-        if 'petroleum gas' not in self.nodes:
-            return
-
-        # Oil refinery uses the same modules
-        factory = factories['chemical plant']
-        advanced_oil_processing, outputs = calculate_forward(
-            factory=factory,
-            input_rate=1.0,
-            factory_input=100,
-            time=5,
-            outputs={'heavy oil': 25, 'light oil': 45, 'petroleum gas': 55})
-        heavy_oil_cracking, light_oil = calculate_forward(
-            factory=factory,
-            input_rate=outputs['heavy oil'],
-            factory_input=40,
-            time=2,
-            outputs={'light oil': 30})
-        light_oil_cracking, petroleum_gas = calculate_forward(
-            factory=factory,
-            input_rate=outputs['light oil'] + light_oil['light oil'],
-            factory_input=30,
-            time=2,
-            outputs={'petroleum gas': 20})
-
-        multiplier = self.nodes['petroleum gas'] / (
-            outputs['petroleum gas'] + petroleum_gas['petroleum gas'])
-
-        def add_raw_input(source: str, target: str, amount: float):
-            self.nodes.setdefault(source, 0.0)
-            self.nodes[source] += amount * multiplier
-            self.edges[(source, target)] = amount * multiplier
-
-        self.nodes['advanced oil processing'] = advanced_oil_processing * multiplier
-        self.nodes['heavy oil cracking'] = heavy_oil_cracking * multiplier
-        self.nodes['light oil cracking'] = light_oil_cracking * multiplier
-
-        self.edges[('advanced oil processing', 'heavy oil cracking')] = outputs['heavy oil'] * multiplier
-        self.edges[('advanced oil processing', 'light oil cracking')] = outputs['light oil'] * multiplier
-        self.edges[('advanced oil processing', 'petroleum gas')] = outputs['petroleum gas'] * multiplier
-        self.edges[('heavy oil cracking', 'light oil cracking')] = light_oil['light oil'] * multiplier
-        self.edges[('light oil cracking', 'petroleum gas')] = petroleum_gas['petroleum gas'] * multiplier
-
-        add_raw_input('crude oil', 'advanced oil processing', 1.0)
-        # add_raw_input('water', 'advanced oil processing', advanced_oil_processing * 50 / 5)
-        # add_raw_input('water', 'heavy oil cracking', heavy_oil_cracking * 30 / 2)
-        # add_raw_input('water', 'light oil cracking', light_oil_cracking * 30 / 2)
-
-        products['water'].category = 'raw'
-
-
-    def render(self) -> None:
-        main_graph = graphviz.Digraph(format='svg')
-        main_graph.body.append('rankdir=LR;\n')
-        subgraphs: Dict[str, graphviz.Digraph] = {}
+        self.oil_processing = OilProcessing.for_factory(
+            self.recipes.factories[oil_processing_factory])
+        self._balance_oil()
+        if 'water' in self.recipes.products:
+            self.recipes = self.recipes.overlay(categories={'water': 'raw'})
 
-        for item, rate in self.nodes.items():
-            product = render_products.get(item)
-            category = None
-            color = None
-            if product is not None:
-                category = product.category
-                color = product.color
-
-            if category is not None:
-                if category not in subgraphs:
-                    g = graphviz.Digraph(category)
-                    g.body.append('rank=same;\n')
-                    subgraphs[category] = g
-                else:
-                    g = subgraphs[category]
-            else:
-                g = main_graph
+    def category(self, item: str) -> Optional[str]:
+        product = self.recipes.render_products.get(item)
+        return product.category if product is not None else None
+
+    def node_attributes(self, item: str) -> Dict[str, Optional[str]]:
+        product = self.recipes.render_products.get(item)
+        color = product.color if product is not None else None
+        return {
+            'label': '{} [{:.1f}]'.format(item, self.nodes[item]),
+            'color': color,
+            'fontcolor': color,
+        }
+
+    def edge_attributes(self, source: str, target: str) -> Dict[str, Optional[str]]:
+        product = self.recipes.render_products.get(source)
+        color = product.color if product is not None else None
+        return {
+            'label': '{:.1f}'.format(self.edges[(source, target)]),
+            'color': color,
+            'fontcolor': color,
+        }
+
+    def dot_lines(self) -> Iterator[str]:
+        # Nodes are grouped by category into subgraphs with the same rank.
+        categories: Dict[Optional[str], List[str]] = {}
+        for item in self.nodes:
+            categories.setdefault(self.category(item), []).append(item)
 
+        def node_line(item: str) -> str:
+            return '\t{}{}\n'.format(quote_dot(item), dot_attributes(**self.node_attributes(item)))
 
-            g.node(item, '{} [{:.1f}]'.format(item, rate),
-                color=color, fontcolor=color)
+        yield 'digraph {\n'
+        yield '\trankdir=LR;\n'
+        for item in categories.pop(None, []):
+            yield node_line(item)
+        for category, items in categories.items():
+            yield '\tsubgraph {} {{\n'.format(quote_dot(category or ''))
+            yield '\t\trank=same;\n'
+            for item in items:
+                yield '\t' + node_line(item)
+            yield '\t}\n'
 
-        for subgraph in subgraphs.values():
-            main_graph.subgraph(subgraph)
+        for source, target in self.edges:
+            yield '\t{} -> {}{}\n'.format(
+                quote_dot(source), quote_dot(target),
+                dot_attributes(**self.edge_attributes(source, target)))
+        yield '}\n'
 
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'expensive': self.expensive,
+            'targets': sorted(self.targets),
+            'nodes': dict(self.nodes),
+            'edges': [
+                {'source': source, 'target': target, 'rate': rate}
+                for (source, target), rate in self.edges.items()
+            ],
+        }
+
+    def write_json(self, output: TextIO) -> None:
+        import json
+        json.dump(self.to_dict(), output, indent=2)
+        output.write('\n')
+
+    def write_csv(self, output: TextIO) -> None:
+        import csv
+        writer = csv.writer(output)
+        writer.writerow(['type', 'source', 'target', 'value'])
+        for item, rate in self.nodes.items():
+            writer.writerow(['node', item, '', rate])
         for (source, target), rate in self.edges.items():
-            color = render_products[source].color
-            main_graph.edge(
-                source, target, label='{:.1f}'.format(rate),
-                color=color, fontcolor=color)
+            writer.writerow(['edge', source, target, rate])
+
+    def render(
+            self,
+            output: Optional[TextIO]=None,
+            format: str='svg',
+            dump_source: bool=False) -> None:
+        # With format 'dot' the source is written as it is, otherwise it is
+        # streamed through the graphviz dot executable.
+        if output is None:
+            output = sys.stdout
+        lines: Iterable[str] = self.dot_lines()
+        if self.profile is not None:
+            lines = self.profile.lines('dot', lines)
+        if dump_source:
+            lines = tee_lines(lines, sys.stderr)
+        if format == 'dot':
+            with self._phase('write'):
+                output.writelines(lines)
+        else:
+            with self._phase('graphviz'):
+                run_dot(lines, output, format)
+
+
+def quote_dot(text: str) -> str:
+    return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def dot_attributes(**attributes: Optional[str]) -> str:
+    values = ' '.join(
+        '{}={}'.format(key, quote_dot(value))
+        for key, value in attributes.items() if value is not None)
+    return ' [{}]'.format(values) if values else ''
+
+
+def tee_lines(lines: Iterable[str], copy: TextIO) -> Iterator[str]:
+    for line in lines:
+        copy.write(line)
+        yield line
+
+
+def run_dot(
+        lines: Iterable[str],
+        output: TextIO,
+        format: str,
+        program: str='dot',
+        options: Sequence[str]=()) -> None:
+    # Write the output of dot directly to the file if it has a descriptor,
+    # so that nothing is buffered here.
+    import subprocess
+    command = [program, '-T' + format, *options]
+    try:
+        fileno: Optional[int] = output.fileno()
+    except (AttributeError, OSError, ValueError):
+        fileno = None
+    try:
+        if fileno is None:
+            result = subprocess.run(
+                command, input=''.join(lines), stdout=subprocess.PIPE, text=True)
+            output.write(result.stdout)
+            returncode = result.returncode
+        else:
+            output.flush()
+            process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=fileno, text=True)
+            assert process.stdin is not None
+            try:
+                with process.stdin:
+                    process.stdin.writelines(lines)
+            except BrokenPipeError:
+                # dot exited early, its exit code tells why.
+                pass
+            returncode = process.wait()
+    except FileNotFoundError:
+        raise RuntimeError('Graphviz {} executable not found'.format(program))
+    if returncode != 0:
+        raise RuntimeError('{} failed with exit code {}'.format(program, returncode))
+
+
+def speed_up_modules(recipes: RecipeSet) -> Dict[str, str]:
+    # Factory types for RecipeSet.overlay or Graph.set_factory_types.
+    return {
+        name: 'assembling machine speed'
+        for name in recipes.products
+        if 'module' in name
+    }
+
+
+def parse_target(recipes: RecipeSet, text: str, expensive: bool=False) -> Tuple[str, float]:
+    # ITEM=RATE, where RATE is items per second, or with a 'b' suffix the
+    # number of buildings producing the item with the given recipe variant.
+    item, separator, rate_text = text.rpartition('=')
+    if not separator:
+        raise RuntimeError('Target must be ITEM=RATE: {}'.format(text))
+    item = recipes.find_product(item.strip())
+    rate_text = rate_text.strip()
+    try:
+        rate = float(rate_text[:-1] if rate_text.endswith('b') else rate_text)
+    except ValueError:
+        raise RuntimeError('Invalid rate: {}'.format(text))
+    if not (math.isfinite(rate) and rate >= 0):
+        raise RuntimeError('Invalid rate: {}'.format(text))
+    if rate_text.endswith('b'):
+        product = recipes.products[item]
+        factory = recipes.factories[product.factory_type]
+        rate = rate * factory.speed * factory.productivity * product.product / \
+            get_recipe(product, expensive)[0]
+    return (item, rate)
+
+
+def write_graph(
+        graph: Graph,
+        output: TextIO,
+        format: str,
+        layout_cache: Optional[str]=None,
+        dump_source: bool=False) -> None:
+    if format == 'json':
+        with graph._phase('write'):
+            graph.write_json(output)
+    elif format == 'csv':
+        with graph._phase('write'):
+            graph.write_csv(output)
+    elif layout_cache is not None and format != 'dot':
+        from layout_cache import LayoutCache
+        with graph._phase('graphviz'):
+            LayoutCache(directory=layout_cache).render(graph, output, format)
+    else:
+        graph.render(output, format, dump_source=dump_source)
+
+
+@contextlib.contextmanager
+def output_file(path: Optional[str]) -> Iterator[TextIO]:
+    # Standard output, or a new file that is removed again if writing it
+    # fails, so that no empty or partial output is left behind.
+    if path is None:
+        yield sys.stdout
+        return
+    output = open(path, 'w')
+    try:
+        with output:
+            yield output
+    except BaseException:
+        os.unlink(path)
+        raise
+
+
+def write_text(content: str, path: Optional[str]) -> None:
+    if path is None:
+        sys.stdout.write(content)
+    else:
+        with open(path, 'w') as f:
+            f.write(content)
+
 
-        print(main_graph.source, file=sys.stderr)
-        print(main_graph.pipe(encoding='utf-8'))
+def compare_expensive(
+        recipes: RecipeSet,
+        targets: Sequence[str],
+        oil_processing: bool,
+        format: str,
+        output_path: Optional[str]) -> None:
+    from mode_comparison import ModeComparison
+    comparison = ModeComparison(recipes, oil_processing)
+    for target in targets:
+        item, rate = parse_target(recipes, target)
+        comparison.add(item, rate, parse_target(recipes, target, True)[1])
+    with output_file(output_path) as output:
+        if format == 'json':
+            comparison.write_json(output)
+        elif format == 'csv':
+            comparison.write_csv(output)
+        else:
+            comparison.render(output, format)
 
 
-def speed_up_modules() -> None:
-    for name, product in products.items():
-        if 'module' in name:
-            product.factory_type = 'assembling machine speed'
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
 
-g = Graph(True)
+    parser = argparse.ArgumentParser(
+        description='Calculate the factories needed to produce items.')
+    parser.add_argument(
+        'targets', nargs='+', metavar='ITEM=RATE',
+        help='item and its rate per second, or number of buildings with a b suffix '
+        '(for example "iron plate=45" or "speed module 3=2b")')
+    parser.add_argument(
+        '-e', '--expensive', action='store_true', help='use expensive recipes')
+    parser.add_argument(
+        '-f', '--format', default='svg',
+        help='json, csv, dot or any graphviz output format (default: svg)')
+    parser.add_argument(
+        '-o', '--output', help='output file (default: standard output)')
+    parser.add_argument(
+        '--no-oil-processing', action='store_true',
+        help='leave oil products as raw inputs')
+    parser.add_argument(
+        '--speed-up-modules', action='store_true',
+        help='make modules in assembling machines with speed modules')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    parser.add_argument(
+        '--layout-cache', metavar='DIRECTORY',
+        help='reuse graphviz layouts of graphs with the same structure')
+    parser.add_argument(
+        '--dump-source', action='store_true', help='write the DOT source to stderr')
+    parser.add_argument(
+        '--result-cache', metavar='DIRECTORY',
+        help='reuse the output of scenarios that were already calculated')
+    parser.add_argument(
+        '--compare-expensive', action='store_true',
+        help='show normal and expensive recipes side by side')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='write the time of every phase and the most expanded products to stderr')
+    args = parser.parse_args(argv)
 
-######## Science ########
-science_pack_factory = factories['assembling machine IM']
-lab = factories['lab']
-science_pack_rate = science_pack_factory.speed * science_pack_factory.productivity * lab.productivity
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        if args.speed_up_modules:
+            recipes = recipes.overlay(factory_types=speed_up_modules(recipes))
 
-# g.add('science', science_pack_rate)
+        if args.compare_expensive:
+            compare_expensive(
+                recipes, args.targets, not args.no_oil_processing, args.format, args.output)
+            return 0
 
-######## Modules ########
+        targets = [parse_target(recipes, target, args.expensive) for target in args.targets]
+        key: Optional[str] = None
+        if args.result_cache is not None:
+            from result_cache import ResultCache, scenario_key, text_formats
+            result_cache = ResultCache(args.result_cache)
+            if args.format in text_formats:
+                key = scenario_key(recipes, args.expensive, not args.no_oil_processing, targets)
+                content = result_cache.get(key, args.format)
+                if content is not None:
+                    write_text(content, args.output)
+                    return 0
 
-# speed_up_modules()
-module = products['speed module 3']
-module_factory = factories[module.factory_type]
-module_rate = module_factory.speed * module_factory.productivity / module.time
+        profile = Profile() if args.profile else None
+        graph = Graph(args.expensive, recipes, profile)
+        if not args.no_oil_processing:
+            graph.add_oil_processing()
+        for item, rate in targets:
+            graph.add(item, rate)
 
-# g.add('speed module 3', module_rate * 2)
-# g.add('productivity module 3', module_rate * 4)
-g.add_oil_processing()
+        if key is None:
+            with output_file(args.output) as output:
+                write_graph(graph, output, args.format, args.layout_cache, args.dump_source)
+        else:
+            # Rates are always stored, so that other formats can be derived
+            # from them later.
+            import io
+            buffer = io.StringIO()
+            write_graph(graph, buffer, args.format, args.layout_cache, args.dump_source)
+            result_cache.put(key, args.format, buffer.getvalue())
+            if args.format != 'json':
+                rates = io.StringIO()
+                graph.write_json(rates)
+                result_cache.put(key, 'json', rates.getvalue())
+            write_text(buffer.getvalue(), args.output)
+        if profile is not None:
+            profile.write(sys.stderr)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    return 0
 
-# g.add('plastic bar', 45)
-g.add('iron plate', 45)
-# g.add('copper wire', 45)
 
-g.render()
+if __name__ == '__main__':
+    sys.exit(main())
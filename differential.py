@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+import json
+import math
+import random
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from calculate import Factory, Graph, RecipeSet
+
+Rates = Tuple[Dict[str, float], Dict[Tuple[str, str], float]]
+# Solves one target on a recipe set: (recipes, expensive, item, rate, oil processing).
+Engine = Callable[[RecipeSet, bool, str, float, bool], Rates]
+
+
+class LegacyGraph:
+    # The original recursive Graph: every input is expanded again for every
+    # consumer, there is no support for recipe cycles and oil processing
+    # only balances petroleum gas. Kept here as the reference the engines of
+    # calculate.py are checked against.
+    def __init__(self, expensive: bool, recipes: RecipeSet) -> None:
+        self.expensive = expensive
+        self.recipes = recipes
+        self.nodes: Dict[str, float] = {'end': 0.0}
+        self.edges: Dict[Tuple[str, str], float] = {}
+        self.targets: Set[str] = set()
+
+    def _add(self, source: str, target: str, rate: float) -> None:
+        product = self.recipes.products[source]
+        factory = self.recipes.factories[product.factory_type]
+
+        time = product.time_expensive if self.expensive and product.time_expensive is not None else product.time
+        inputs = product.input_expensive if self.expensive and product.input_expensive is not None else product.inputs
+
+        self.nodes.setdefault(source, 0.0)
+        self.nodes[source] += rate * time / factory.speed / factory.productivity / product.product
+        self.edges.setdefault((source, target), 0.0)
+        self.edges[(source, target)] += rate
+
+        for input, amount in inputs.items():
+            self._add(input, source, rate * amount / factory.productivity / product.product)
+
+    def add(self, item: str, rate: float) -> None:
+        if item not in self.recipes.products:
+            raise RuntimeError('Item not found: {}'.format(item))
+        self.targets.add(item)
+        self._add(item, 'end', rate)
+
+    def add_oil_processing(self) -> None:
+        if 'heavy oil' in self.nodes or 'light oil' in self.nodes:
+            raise RuntimeError('Only petroleum gas is supported')
+        if 'petroleum gas' not in self.nodes:
+            return
+
+        # Oil refinery uses the same modules
+        factory = self.recipes.factories['chemical plant']
+
+        def forward(input_rate: float, factory_input: float, time: float,
+                    outputs: Dict[str, float]) -> Tuple[float, Dict[str, float]]:
+            return (
+                input_rate * time / factory_input / factory.speed,
+                {
+                    name: rate * factory.productivity * input_rate / factory_input
+                    for name, rate in outputs.items()
+                })
+
+        advanced_oil_processing, outputs = forward(
+            1.0, 100, 5, {'heavy oil': 25, 'light oil': 45, 'petroleum gas': 55})
+        heavy_oil_cracking, light_oil = forward(outputs['heavy oil'], 40, 2, {'light oil': 30})
+        light_oil_cracking, petroleum_gas = forward(
+            outputs['light oil'] + light_oil['light oil'], 30, 2, {'petroleum gas': 20})
+
+        multiplier = self.nodes['petroleum gas'] / (
+            outputs['petroleum gas'] + petroleum_gas['petroleum gas'])
+
+        self.nodes['advanced oil processing'] = advanced_oil_processing * multiplier
+        self.nodes['heavy oil cracking'] = heavy_oil_cracking * multiplier
+        self.nodes['light oil cracking'] = light_oil_cracking * multiplier
+
+        self.edges[('advanced oil processing', 'heavy oil cracking')] = outputs['heavy oil'] * multiplier
+        self.edges[('advanced oil processing', 'light oil cracking')] = outputs['light oil'] * multiplier
+        self.edges[('advanced oil processing', 'petroleum gas')] = outputs['petroleum gas'] * multiplier
+        self.edges[('heavy oil cracking', 'light oil cracking')] = light_oil['light oil'] * multiplier
+        self.edges[('light oil cracking', 'petroleum gas')] = petroleum_gas['petroleum gas'] * multiplier
+
+        self.nodes.setdefault('crude oil', 0.0)
+        self.nodes['crude oil'] += multiplier
+        self.edges[('crude oil', 'advanced oil processing')] = multiplier
+
+
+def solve_legacy(
+        recipes: RecipeSet, expensive: bool, item: str, rate: float, oil_processing: bool) -> Rates:
+    graph = LegacyGraph(expensive, recipes)
+    graph.add(item, rate)
+    if oil_processing:
+        graph.add_oil_processing()
+    return (graph.nodes, graph.edges)
+
+
+def solve_graph(
+        recipes: RecipeSet, expensive: bool, item: str, rate: float, oil_processing: bool) -> Rates:
+    graph = Graph(expensive, recipes)
+    graph.add(item, rate)
+    if oil_processing:
+        graph.add_oil_processing()
+    return (dict(graph.nodes), dict(graph.edges))
+
+
+def solve_incremental(
+        recipes: RecipeSet, expensive: bool, item: str, rate: float, oil_processing: bool) -> Rates:
+    # Solves with plain factories first and then sets the real ones one by
+    # one, which recomputes only the products each of them makes.
+    graph = Graph(expensive, recipes.overlay(factories={
+        factory_type: Factory(1.0, 1.0) for factory_type in recipes.factories
+    }))
+    graph.add(item, rate)
+    if oil_processing:
+        graph.add_oil_processing()
+    for factory_type, factory in recipes.factories.items():
+        graph.set_factory(factory_type, factory)
+    return (dict(graph.nodes), dict(graph.edges))
+
+
+matrices: Dict[Tuple[int, bool], Tuple[RecipeSet, Any]] = {}
+
+
+def solve_matrix(
+        recipes: RecipeSet, expensive: bool, item: str, rate: float, oil_processing: bool) -> Rates:
+    from recipe_matrix import RecipeMatrix
+
+    # The matrix is built once per recipe set, like the caches of Graph.
+    key = (id(recipes), expensive)
+    if key not in matrices:
+        matrices[key] = (recipes, RecipeMatrix(expensive, recipes))
+    solution = matrices[key][1].solve_all([{item: rate}], oil_processing)
+    return (solution.nodes(0), solution.edges(0))
+
+
+engines: Dict[str, Engine] = {
+    'graph': solve_graph,
+    'incremental': solve_incremental,
+    'matrix': solve_matrix,
+}
+
+
+def random_factories(recipes: RecipeSet, random_state: random.Random) -> Dict[str, Factory]:
+    # Any speed from a bare machine to one full of speed modules and
+    # productivity up to four productivity modules. Raw resources stay as
+    # they are.
+    return {
+        factory_type: Factory(random_state.uniform(0.5, 5.0), random_state.uniform(1.0, 1.4))
+        for factory_type in recipes.factories if factory_type != 'raw'
+    }
+
+
+def difference(
+        expected: Mapping[Any, float],
+        actual: Mapping[Any, float],
+        tolerance: float) -> Optional[str]:
+    # First rate that doesn't match, a missing key counting as zero.
+    for key in sorted(set(expected) | set(actual), key=str):
+        a = expected.get(key, 0.0)
+        b = actual.get(key, 0.0)
+        if not math.isclose(a, b, rel_tol=tolerance, abs_tol=tolerance):
+            return '{}: {!r} != {!r}'.format(key, a, b)
+    return None
+
+
+def best_time(function: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class CaseResult:
+    def __init__(
+            self,
+            engine: str,
+            target: str,
+            expensive: bool,
+            oil_processing: bool,
+            config: int,
+            error: Optional[str],
+            legacy_time: float,
+            engine_time: float) -> None:
+        self.engine = engine
+        self.target = target
+        self.expensive = expensive
+        self.oil_processing = oil_processing
+        # 0 is the default factories, the others are random.
+        self.config = config
+        self.error = error
+        self.legacy_time = legacy_time
+        self.engine_time = engine_time
+
+    @property
+    def speedup(self) -> float:
+        return self.legacy_time / self.engine_time if self.engine_time else math.inf
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'engine': self.engine,
+            'target': self.target,
+            'expensive': self.expensive,
+            'oil_processing': self.oil_processing,
+            'config': self.config,
+            'error': self.error,
+            'legacy_time': self.legacy_time,
+            'engine_time': self.engine_time,
+            'speedup': self.speedup,
+        }
+
+
+def _run_case(
+        recipes: RecipeSet,
+        engine_names: Sequence[str],
+        expensive: bool,
+        oil_processing: bool,
+        config: int,
+        target: str,
+        rate: float,
+        tolerance: float,
+        repeat: int,
+        skipped: List[str]) -> List[CaseResult]:
+    def legacy() -> Rates:
+        return solve_legacy(recipes, expensive, target, rate, oil_processing)
+    try:
+        expected = legacy()
+    except (RuntimeError, RecursionError) as e:
+        skipped.append('{} (expensive={}, oil processing={}, config {}): {}'.format(
+            target, expensive, oil_processing, config, e.__class__.__name__
+            if isinstance(e, RecursionError) else e))
+        return []
+    legacy_time = best_time(legacy, repeat)
+
+    results = []
+    for name in engine_names:
+        def solve(engine: Engine=engines[name]) -> Rates:
+            return engine(recipes, expensive, target, rate, oil_processing)
+        engine_time = 0.0
+        try:
+            nodes, edges = solve()
+            error = difference(expected[0], nodes, tolerance) or \
+                difference(expected[1], edges, tolerance)
+            engine_time = best_time(solve, repeat)
+        except RuntimeError as e:
+            error = str(e)
+        results.append(CaseResult(
+            name, target, expensive, oil_processing, config, error, legacy_time, engine_time))
+    return results
+
+
+def run_differential(
+        recipes: RecipeSet,
+        engine_names: Sequence[str],
+        configs: int=3,
+        rate: float=7.5,
+        oil_processing: Sequence[bool]=(False, True),
+        tolerance: float=1e-9,
+        repeat: int=3,
+        seed: int=0,
+        targets: Optional[Sequence[str]]=None) -> Tuple[List[CaseResult], List[str]]:
+    # Solves every target in both modes, with and without oil processing
+    # unless oil_processing says otherwise, on the default factories and on
+    # configs random ones with the legacy Graph and each engine. Returns a
+    # result per engine and case and the cases the legacy Graph can't solve
+    # (recipe cycles, heavy or light oil with oil processing), which are not
+    # compared. Engines are run once before timing, so their caches are warm.
+    random_state = random.Random(seed)
+    recipe_sets = [recipes] + [
+        recipes.overlay(factories=random_factories(recipes, random_state)) for _ in range(configs)
+    ]
+    results: List[CaseResult] = []
+    skipped: List[str] = []
+    for config, config_recipes in enumerate(recipe_sets):
+        for expensive in (False, True):
+            for oil in oil_processing:
+                for target in targets or sorted(config_recipes.products):
+                    results.extend(_run_case(
+                        config_recipes, engine_names, expensive, oil, config, target, rate,
+                        tolerance, repeat, skipped))
+    return (results, skipped)
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Check the solver engines against the legacy recursive Graph and time them.')
+    parser.add_argument(
+        '--engine', action='append', choices=sorted(engines),
+        help='engine to check, can be repeated (default: all)')
+    parser.add_argument(
+        '--configs', type=int, default=3,
+        help='random factory configurations besides the default one (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random factories')
+    parser.add_argument(
+        '--target', action='append', help='only check this item, can be repeated')
+    parser.add_argument(
+        '--oil-processing', choices=('both', 'on', 'off'), default='both',
+        help='solve with oil processing, without or both (default: both); with oil '
+        'processing only targets that need no heavy or light oil are compared')
+    parser.add_argument(
+        '--tolerance', type=float, default=1e-9,
+        help='allowed relative and absolute difference of rates (default: 1e-9)')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='timed runs per case, the best is kept (default: 3)')
+    parser.add_argument('-o', '--output', help='save every case as JSON')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    engine_names = args.engine or sorted(engines)
+    oil_processing = {'both': (False, True), 'on': (True,), 'off': (False,)}[args.oil_processing]
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        targets = [recipes.find_product(item) for item in args.target or []]
+        results, skipped = run_differential(
+            recipes, engine_names, args.configs, oil_processing=oil_processing,
+            tolerance=args.tolerance, repeat=args.repeat, seed=args.seed, targets=targets)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    failures = [result for result in results if result.error is not None]
+    for result in failures:
+        print('Mismatch: {} {} (expensive={}, oil processing={}, config {}): {}'.format(
+            result.engine, result.target, result.expensive, result.oil_processing, result.config,
+            result.error), file=sys.stderr)
+    for name in engine_names:
+        passed = [result for result in results if result.engine == name and result.error is None]
+        count = sum(1 for result in results if result.engine == name)
+        if not passed:
+            print('{:<12} {:>5}/{} cases match'.format(name, 0, count))
+            continue
+        speedups = [result.speedup for result in passed]
+        slowest = min(passed, key=lambda result: result.speedup)
+        fastest = max(passed, key=lambda result: result.speedup)
+        print('{:<12} {:>5}/{} cases match, speedup median {:.2f}x, min {:.2f}x ({}), '
+              'max {:.2f}x ({})'.format(
+                  name, len(passed), count, statistics.median(speedups), slowest.speedup,
+                  slowest.target, fastest.speedup, fastest.target))
+    if skipped:
+        print('{} cases not supported by the legacy Graph'.format(len(skipped)))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'cases': [result.to_dict() for result in results],
+                'skipped': skipped,
+            }, f, indent=2)
+            f.write('\n')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from calculate import Factory, Product, RecipeSet, default_recipes, factories, oil_products, products
+
+# Increase whenever the parsing below changes, so that old caches are not used.
+cache_version = 2
+
+# Recipe categories of the assembling machines. Recipes that accept
+# productivity modules go to 'assembling machine IM', the rest to
+# 'assembling machine final'.
+crafting_categories = {'crafting', 'advanced-crafting', 'crafting-with-fluid'}
+
+category_factories = {
+    'smelting': 'furnace',
+    'chemistry': 'chemical plant',
+    'oil-processing': 'chemical plant',
+    'rocket-building': 'rocket silo',
+}
+
+# Used when an item has several recipes and none of them has the same name.
+preferred_recipes = {
+    'solid-fuel': 'solid-fuel-from-light-oil',
+}
+
+machine_types = ('assembling-machine', 'furnace', 'rocket-silo')
+
+
+def display_name(name: str) -> str:
+    return name.replace('-', ' ')
+
+
+def default_color(name: str) -> str:
+    # Stable, reasonably dark color for items without a hand-picked one.
+    digest = hashlib.md5(name.encode('utf-8')).digest()
+    return '#{:02x}{:02x}{:02x}'.format(*(64 + byte % 128 for byte in digest[:3]))
+
+
+def _entries(value: Any) -> Iterable[Any]:
+    # Empty Lua tables are dumped as {} instead of [].
+    if isinstance(value, dict):
+        return value.values()
+    return value
+
+
+def _amount(entry: Any) -> Tuple[str, float]:
+    if isinstance(entry, list):
+        return (entry[0], float(entry[1]))
+    if 'amount' in entry:
+        amount = float(entry['amount'])
+    else:
+        amount = (float(entry['amount_min']) + float(entry['amount_max'])) / 2
+    return (entry['name'], amount * float(entry.get('probability', 1.0)))
+
+
+def _amounts(entries: Any) -> Dict[str, float]:
+    result: Dict[str, float] = {}
+    for entry in _entries(entries):
+        name, amount = _amount(entry)
+        name = display_name(name)
+        result[name] = result.get(name, 0.0) + amount
+    return result
+
+
+def _recipe_variant(recipe: Dict[str, Any]) -> Tuple[float, Dict[str, float], Dict[str, float]]:
+    if 'results' in recipe:
+        results = _amounts(recipe['results'])
+    else:
+        results = {display_name(recipe['result']): float(recipe.get('result_count', 1))}
+    return (
+        float(recipe.get('energy_required', 0.5)),
+        _amounts(recipe.get('ingredients', [])),
+        results)
+
+
+def _variants(recipe: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    # Recipes either have the fields directly or separate normal and expensive
+    # variants, one of which may be false if the recipe is disabled there.
+    normal = recipe.get('normal') or recipe.get('expensive') or recipe
+    return (normal, recipe.get('expensive') or normal)
+
+
+def _find_recipes(
+        data: Dict[str, Any]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    # Pick one recipe with a single result for every item. Items that only
+    # come from recipes with byproducts (oil processing, uranium processing)
+    # are left out and become raw inputs. Oil products are always raw, they
+    # are balanced by OilProcessing.
+    candidates: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+    for name, recipe in data.get('recipe', {}).items():
+        _, _, results = _recipe_variant(_variants(recipe)[0])
+        if len(results) != 1:
+            continue
+        item = next(iter(results))
+        if item in oil_products:
+            continue
+        candidates.setdefault(item, []).append((name, recipe))
+
+    chosen: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    for item, recipes in candidates.items():
+        recipes.sort(key=lambda entry: (bool(entry[1].get('hidden')), entry[0]))
+        raw_name = item.replace(' ', '-')
+        preferred = preferred_recipes.get(raw_name, raw_name)
+        chosen[item] = next(
+            (entry for entry in recipes if entry[0] == preferred), recipes[0])
+    return chosen
+
+
+def _productivity_recipes(data: Dict[str, Any]) -> Set[str]:
+    result: Set[str] = set()
+    for module in data.get('module', {}).values():
+        result.update(_entries(module.get('limitation', [])))
+    return result
+
+
+def _machine_speeds(data: Dict[str, Any]) -> Dict[str, float]:
+    speeds: Dict[str, float] = {}
+    for machine_type in machine_types:
+        for machine in data.get(machine_type, {}).values():
+            for category in _entries(machine.get('crafting_categories', [])):
+                speeds[category] = max(
+                    speeds.get(category, 0.0), float(machine.get('crafting_speed', 1.0)))
+    return speeds
+
+
+def parse_data_dump(data: Dict[str, Any]) -> Tuple[Dict[str, Product], Dict[str, Factory]]:
+    # Returns the products and the factories needed for recipe categories
+    # that are not in the hand-picked factory table.
+    productivity_recipes = _productivity_recipes(data)
+    machine_speeds = _machine_speeds(data)
+    new_products: Dict[str, Product] = {}
+    new_factories: Dict[str, Factory] = {}
+
+    def color(name: str) -> str:
+        known = products.get(name)
+        return known.color if known is not None else default_color(name)
+
+    for item, (recipe_name, recipe) in sorted(_find_recipes(data).items()):
+        normal, expensive = _variants(recipe)
+        time, inputs, results = _recipe_variant(normal)
+        time_expensive, input_expensive, _ = _recipe_variant(expensive)
+
+        category = recipe.get('category', 'crafting')
+        if category in crafting_categories:
+            factory_type = 'assembling machine IM' if recipe_name in productivity_recipes \
+                else 'assembling machine final'
+        elif category in category_factories:
+            factory_type = category_factories[category]
+        else:
+            factory_type = category
+            if factory_type not in factories and factory_type not in new_factories:
+                new_factories[factory_type] = Factory(machine_speeds.get(category, 1.0), 1.0)
+
+        render_category = None
+        if category == 'smelting':
+            render_category = 'plate'
+        elif item.replace(' ', '-') in data.get('tool', {}):
+            render_category = 'science'
+
+        new_products[item] = Product(
+            time=time,
+            inputs=inputs,
+            color=color(item),
+            factory_type=factory_type,
+            product=results[item],
+            time_expensive=time_expensive if time_expensive != time else None,
+            input_expensive=input_expensive if input_expensive != inputs else None,
+            category=render_category)
+
+    # Everything else that is used as an ingredient is a raw input, as well
+    # as everything oil processing works with.
+    resources = data.get('resource', {})
+    used = ['crude oil', 'water', *oil_products]
+    for product in new_products.values():
+        used.extend(product.inputs)
+        used.extend(product.input_expensive or {})
+    for item in used:
+        if item in new_products:
+            continue
+        raw_name = item.replace(' ', '-')
+        if raw_name in resources and raw_name in data.get('item', {}):
+            minable = resources[raw_name].get('minable', {})
+            new_products[item] = Product(
+                time=float(minable.get('mining_time', 1)),
+                inputs={},
+                factory_type='mining drill',
+                color=color(item),
+                category='raw')
+        else:
+            is_fluid = raw_name in data.get('fluid', {}) and raw_name not in resources
+            new_products[item] = Product(
+                time=1,
+                inputs={},
+                factory_type='raw',
+                color=color(item),
+                category='fluid' if is_fluid else 'raw')
+
+    return (new_products, new_factories)
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'factorio-utils')
+
+
+def load_data_dump(
+        path: str,
+        cache_dir: Optional[str]=None) -> Tuple[Dict[str, Product], Dict[str, Factory]]:
+    # The parsed recipes are cached by the hash of the dump, so only the
+    # first run has to parse the JSON.
+    with open(path, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha256(content).hexdigest()
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    cache_path = os.path.join(cache_dir, 'recipes-{}-{}.pickle'.format(cache_version, key))
+
+    try:
+        with open(cache_path, 'rb') as f:
+            result: Tuple[Dict[str, Product], Dict[str, Factory]] = pickle.load(f)
+            return result
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    result = parse_data_dump(json.loads(content))
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return result
+
+
+def load_recipe_set(path: str, cache_dir: Optional[str]=None) -> RecipeSet:
+    new_products, new_factories = load_data_dump(path, cache_dir)
+    return RecipeSet(new_products, {**factories, **new_factories})
+
+
+def load_recipes(path: Optional[str]) -> RecipeSet:
+    # For the --data-dump option of the command line tools: the recipes of
+    # a data dump, or the built-in ones without one.
+    if path is None:
+        return default_recipes()
+    try:
+        return load_recipe_set(path)
+    except (OSError, ValueError) as e:
+        raise RuntimeError('Cannot read {}: {}'.format(path, e))
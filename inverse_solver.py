@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import numpy
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from calculate import (
+    OilProcessing, RecipeSet, default_recipes, get_recipe, oil_processing_factory, oil_products)
+
+
+def simplex(objective: numpy.ndarray, matrix: numpy.ndarray, bounds: numpy.ndarray) -> numpy.ndarray:
+    # Maximizes objective @ x subject to matrix @ x <= bounds and x >= 0,
+    # where bounds >= 0 so that x = 0 is feasible. Returns x followed by the
+    # slack of every constraint. Bland's rule keeps it from cycling.
+    rows, columns = matrix.shape
+    tableau = numpy.zeros((rows + 1, columns + rows + 1))
+    tableau[:rows, :columns] = matrix
+    tableau[:rows, columns:columns + rows] = numpy.eye(rows)
+    tableau[:rows, -1] = bounds
+    tableau[rows, :columns] = -objective
+    basis = list(range(columns, columns + rows))
+    while True:
+        entering = next(
+            (j for j in range(columns + rows) if tableau[rows, j] < -1e-12), None)
+        if entering is None:
+            break
+        candidates = [
+            (tableau[i, -1] / tableau[i, entering], basis[i], i)
+            for i in range(rows) if tableau[i, entering] > 1e-12
+        ]
+        if not candidates:
+            raise RuntimeError('Output is not limited by the budget')
+        _, _, pivot = min(candidates)
+        tableau[pivot] /= tableau[pivot, entering]
+        for i in range(rows + 1):
+            if i != pivot and tableau[i, entering] != 0.0:
+                tableau[i] -= tableau[i, entering] * tableau[pivot]
+        basis[pivot] = entering
+
+    result = numpy.zeros(columns + rows)
+    for i, j in enumerate(basis):
+        result[j] = tableau[i, -1]
+    return result
+
+
+class MaximumOutput:
+    def __init__(
+            self,
+            rates: Dict[str, float],
+            usage: Dict[str, float],
+            binding: List[str]) -> None:
+        self.rates = rates
+        self.usage = usage
+        self.binding = binding
+
+
+class InverseSolver:
+    # Maximum output of the targets from a budget of raw resources per
+    # second, as a linear program over the per-unit raw costs of the targets.
+    # With oil processing the refinery and cracking rates are variables of
+    # the program too, so the oil products of several targets are balanced
+    # together. Targets map items to their weight in the objective; raw
+    # resources without a budget are unlimited.
+    def __init__(
+            self,
+            targets: Dict[str, float],
+            budget: Dict[str, float],
+            expensive: bool,
+            oil_processing: bool=True,
+            recipes: Optional[RecipeSet]=None) -> None:
+        self.recipes = default_recipes() if recipes is None else recipes
+        self.targets = {
+            self.recipes.find_product(item): weight for item, weight in targets.items()
+        }
+        self.budget = {
+            self.recipes.find_product(item): rate for item, rate in budget.items()
+        }
+        if any(rate < 0 for rate in self.budget.values()):
+            raise RuntimeError('Budget must not be negative')
+        for item in self.budget:
+            if get_recipe(self.recipes.products[item], expensive)[1]:
+                raise RuntimeError('Budget of {} is not a raw input'.format(item))
+        self.expensive = expensive
+        self.oil_processing = oil_processing
+
+    def _raw_costs(self) -> Dict[str, Dict[str, float]]:
+        costs = self.recipes.costs(self.expensive)
+        return {item: costs.raw(item) for item in self.targets}
+
+    def solve(self) -> MaximumOutput:
+        raw_costs = self._raw_costs()
+        items = list(self.targets)
+        resources = list(self.budget)
+        # Variables: the target rates, then the crude oil rate and the heavy
+        # and light oil cracking rates.
+        oil = self.oil_processing
+        columns = len(items) + (3 if oil else 0)
+        rows: List[List[float]] = []
+        bounds: List[float] = []
+        for resource in resources:
+            row = [raw_costs[item].get(resource, 0.0) for item in items]
+            if oil:
+                if resource in oil_products:
+                    raise RuntimeError(
+                        'Budget of {} with oil processing, use crude oil instead'.format(resource))
+                row += [1.0 if resource == 'crude oil' else 0.0, 0.0, 0.0]
+            rows.append(row)
+            bounds.append(self.budget[resource])
+
+        if oil:
+            processing = OilProcessing.for_factory(
+                self.recipes.factories[oil_processing_factory])
+            # Oil demand of the targets minus what the refinery and cracking
+            # produce must not be positive.
+            heavy, light, gas = (
+                [raw_costs[item].get(product, 0.0) for item in items] for product in oil_products)
+            rows.append(heavy + [-processing.heavy_oil, 1.0, 0.0])
+            rows.append(light + [-processing.light_oil, -processing.heavy_to_light, 1.0])
+            rows.append(gas + [-processing.petroleum_gas, 0.0, -processing.light_to_gas])
+            bounds += [0.0, 0.0, 0.0]
+
+        solution = simplex(
+            numpy.array(list(self.targets.values()) + [0.0] * (columns - len(items))),
+            numpy.array(rows, dtype=numpy.float64).reshape(len(rows), columns),
+            numpy.array(bounds, dtype=numpy.float64))
+
+        rates = {item: float(solution[j]) for j, item in enumerate(items)}
+        usage = {
+            resource: float(numpy.dot(rows[i], solution[:columns]))
+            for i, resource in enumerate(resources)
+        }
+        binding = [
+            resource for i, resource in enumerate(resources)
+            if solution[columns + i] <= 1e-9 * max(1.0, self.budget[resource])
+        ]
+        return MaximumOutput(rates, usage, binding)
+
+
+def parse_rate(recipes: RecipeSet, text: str) -> Tuple[str, float]:
+    item, separator, rate_text = text.rpartition('=')
+    if not separator:
+        return (recipes.find_product(text.strip()), 1.0)
+    try:
+        return (recipes.find_product(item.strip()), float(rate_text))
+    except ValueError:
+        raise RuntimeError('Invalid rate: {}'.format(text))
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Calculate the maximum output of items from a budget of raw resources.')
+    parser.add_argument(
+        'targets', nargs='+', metavar='ITEM[=WEIGHT]',
+        help='item to maximize, optionally with its weight in the objective')
+    parser.add_argument(
+        '-b', '--budget', action='append', required=True, metavar='ITEM=RATE',
+        help='raw resource and its available rate per second (for example "iron ore=45")')
+    parser.add_argument(
+        '-e', '--expensive', action='store_true', help='use expensive recipes')
+    parser.add_argument(
+        '--no-oil-processing', action='store_true',
+        help='leave oil products as raw inputs')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        targets = dict(parse_rate(recipes, text) for text in args.targets)
+        budget = dict(parse_rate(recipes, text) for text in args.budget)
+        result = InverseSolver(
+            targets, budget, args.expensive, not args.no_oil_processing, recipes).solve()
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    for item, rate in result.rates.items():
+        print('{}: {:.4f}/s'.format(item, rate))
+    for resource, used in result.usage.items():
+        print('{}: {:.4f} of {:.4f}/s{}'.format(
+            resource, used, budget[resource], ' (binding)' if resource in result.binding else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
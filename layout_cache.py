@@ -0,0 +1,156 @@
+import collections
+import hashlib
+import io
+import json
+import os
+import sys
+from typing import Dict, Iterator, Optional, TextIO, Tuple
+
+from calculate import Graph, dot_attributes, quote_dot, run_dot
+
+
+class Layout:
+    # Positions computed by dot: the bounding box, the position and size of
+    # every node and the spline and label position of every edge.
+    def __init__(
+            self,
+            bounding_box: str,
+            nodes: Dict[str, Tuple[str, str, str]],
+            edges: Dict[Tuple[str, str], Tuple[str, Optional[str]]]) -> None:
+        self.bounding_box = bounding_box
+        self.nodes = nodes
+        self.edges = edges
+
+    @staticmethod
+    def from_graphviz_json(text: str) -> 'Layout':
+        # Output of dot -Tjson. Subgraphs come first in the objects, edges
+        # refer to the nodes by their id.
+        data = json.loads(text)
+        objects = data.get('objects', [])
+        by_id = {
+            node['_gvid']: node
+            for node in objects[data.get('_subgraph_cnt', 0):]
+        }
+        nodes = {
+            node['name']: (node['pos'], node['width'], node['height'])
+            for node in by_id.values()
+        }
+        edges = {
+            (by_id[edge['tail']]['name'], by_id[edge['head']]['name']):
+                (edge['pos'], edge.get('lp'))
+            for edge in data.get('edges', [])
+        }
+        return Layout(data['bb'], nodes, edges)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'bb': self.bounding_box,
+            'nodes': self.nodes,
+            'edges': [[source, target, pos, lp] for (source, target), (pos, lp) in self.edges.items()],
+        })
+
+    @staticmethod
+    def from_json(text: str) -> 'Layout':
+        data = json.loads(text)
+        return Layout(
+            data['bb'],
+            {name: (pos, width, height) for name, (pos, width, height) in data['nodes'].items()},
+            {(source, target): (pos, lp) for source, target, pos, lp in data['edges']})
+
+
+def topology_key(graph: Graph) -> str:
+    # Everything the layout depends on except the labels: the nodes in order
+    # with their category, and the edges in order.
+    digest = hashlib.sha256()
+    for item in graph.nodes:
+        digest.update(json.dumps([item, graph.category(item)]).encode('utf-8'))
+    digest.update(b'\0')
+    for edge in graph.edges:
+        digest.update(json.dumps(edge).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def positioned_dot_lines(graph: Graph, layout: Layout) -> Iterator[str]:
+    # DOT source with every position fixed, for neato -n2 which only draws.
+    yield 'digraph {\n'
+    yield '\tgraph [bb={}];\n'.format(quote_dot(layout.bounding_box))
+    for item in graph.nodes:
+        pos, width, height = layout.nodes[item]
+        yield '\t{}{}\n'.format(quote_dot(item), dot_attributes(
+            pos=pos, width=width, height=height, **graph.node_attributes(item)))
+    for source, target in graph.edges:
+        pos, lp = layout.edges[(source, target)]
+        yield '\t{} -> {}{}\n'.format(quote_dot(source), quote_dot(target), dot_attributes(
+            pos=pos, lp=lp, **graph.edge_attributes(source, target)))
+    yield '}\n'
+
+
+class LayoutCache:
+    # Keeps the dot layout of recently rendered graphs by topology, so that
+    # rendering a graph that only differs in rates skips the layout pass.
+    # Optionally the layouts are also stored in a directory.
+    def __init__(self, size: int=64, directory: Optional[str]=None) -> None:
+        self.size = size
+        self.directory = directory
+        self.layouts: 'collections.OrderedDict[str, Layout]' = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> Optional[str]:
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, 'layout-{}.json'.format(key))
+
+    def get(self, key: str) -> Optional[Layout]:
+        layout = self.layouts.get(key)
+        if layout is not None:
+            self.layouts.move_to_end(key)
+            return layout
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                layout = Layout.from_json(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        self._store(key, layout)
+        return layout
+
+    def _store(self, key: str, layout: Layout) -> None:
+        self.layouts[key] = layout
+        self.layouts.move_to_end(key)
+        while len(self.layouts) > self.size:
+            self.layouts.popitem(last=False)
+
+    def put(self, key: str, layout: Layout) -> None:
+        self._store(key, layout)
+        path = self._path(key)
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as f:
+                f.write(layout.to_json())
+            os.replace(temp_path, path)
+
+    def layout(self, graph: Graph) -> Layout:
+        key = topology_key(graph)
+        layout = self.get(key)
+        if layout is not None:
+            self.hits += 1
+            return layout
+        self.misses += 1
+        output = io.StringIO()
+        run_dot(graph.dot_lines(), output, 'json')
+        layout = Layout.from_graphviz_json(output.getvalue())
+        self.put(key, layout)
+        return layout
+
+    def render(self, graph: Graph, output: Optional[TextIO]=None, format: str='svg') -> None:
+        if output is None:
+            output = sys.stdout
+        if format == 'dot':
+            output.writelines(graph.dot_lines())
+            return
+        layout = self.layout(graph)
+        run_dot(positioned_dot_lines(graph, layout), output, format, program='neato', options=['-n2'])
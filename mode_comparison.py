@@ -0,0 +1,145 @@
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from calculate import Graph, RecipeSet, default_recipes, dot_attributes, quote_dot, run_dot
+
+Rates = Tuple[float, float]
+
+
+class ModeComparison:
+    # Normal and expensive recipes side by side: every node and edge has the
+    # rate with both recipe variants. Both graphs share the recipe set, so
+    # names are resolved and unit costs are computed once per variant.
+    def __init__(self, recipes: Optional[RecipeSet]=None, oil_processing: bool=True) -> None:
+        self.recipes = default_recipes() if recipes is None else recipes
+        self.graphs = (Graph(False, self.recipes), Graph(True, self.recipes))
+        if oil_processing:
+            for graph in self.graphs:
+                graph.add_oil_processing()
+
+    def add(self, item: str, rate: float, expensive_rate: Optional[float]=None) -> None:
+        # A target given as a number of buildings has a different rate with
+        # each recipe variant.
+        item = self.recipes.find_product(item)
+        normal, expensive = self.graphs
+        normal.add(item, rate)
+        expensive.add(item, rate if expensive_rate is None else expensive_rate)
+
+    @property
+    def nodes(self) -> Dict[str, Rates]:
+        normal, expensive = self.graphs
+        names = dict.fromkeys([*normal.nodes, *expensive.nodes])
+        return {
+            name: (normal.nodes.get(name, 0.0), expensive.nodes.get(name, 0.0))
+            for name in names
+        }
+
+    @property
+    def edges(self) -> Dict[Tuple[str, str], Rates]:
+        normal, expensive = self.graphs
+        edges = dict.fromkeys([*normal.edges, *expensive.edges])
+        return {
+            edge: (normal.edges.get(edge, 0.0), expensive.edges.get(edge, 0.0))
+            for edge in edges
+        }
+
+    def _graph(self, item: str) -> Graph:
+        # A graph with the item, for its category and color.
+        normal, expensive = self.graphs
+        return normal if item in normal.nodes else expensive
+
+    def _edge_graph(self, edge: Tuple[str, str]) -> Graph:
+        normal, expensive = self.graphs
+        return normal if edge in normal.edges else expensive
+
+    def node_attributes(self, item: str, rates: Rates) -> Dict[str, Optional[str]]:
+        normal, expensive = rates
+        attributes = self._graph(item).node_attributes(item)
+        attributes['label'] = '{} [{:.1f} | {:.1f}]{}'.format(
+            item, normal, expensive, difference(normal, expensive))
+        if expensive > normal + 0.05:
+            attributes['style'] = 'bold'
+        return attributes
+
+    def edge_attributes(self, source: str, target: str, rates: Rates) -> Dict[str, Optional[str]]:
+        normal, expensive = rates
+        attributes = self._edge_graph((source, target)).edge_attributes(source, target)
+        attributes['label'] = '{:.1f} | {:.1f}'.format(normal, expensive)
+        if normal == 0.0 or expensive == 0.0:
+            attributes['style'] = 'dashed'
+        return attributes
+
+    def dot_lines(self) -> Iterator[str]:
+        # The same layout as Graph.dot_lines, with the normal and expensive
+        # rate in every label. Nodes that need more buildings with expensive
+        # recipes are bold, edges that only exist in one variant dashed.
+        nodes = self.nodes
+        categories: Dict[Optional[str], List[str]] = {}
+        for item in nodes:
+            categories.setdefault(self._graph(item).category(item), []).append(item)
+
+        def node_line(item: str) -> str:
+            return '\t{}{}\n'.format(
+                quote_dot(item), dot_attributes(**self.node_attributes(item, nodes[item])))
+
+        yield 'digraph {\n'
+        yield '\trankdir=LR;\n'
+        yield '\tlabel="buildings and rates: normal | expensive";\n'
+        for item in categories.pop(None, []):
+            yield node_line(item)
+        for category, items in categories.items():
+            yield '\tsubgraph {} {{\n'.format(quote_dot(category or ''))
+            yield '\t\trank=same;\n'
+            for item in items:
+                yield '\t' + node_line(item)
+            yield '\t}\n'
+
+        for (source, target), rates in self.edges.items():
+            yield '\t{} -> {}{}\n'.format(
+                quote_dot(source), quote_dot(target),
+                dot_attributes(**self.edge_attributes(source, target, rates)))
+        yield '}\n'
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'targets': sorted(self.graphs[0].targets),
+            'nodes': {
+                name: {'normal': normal, 'expensive': expensive}
+                for name, (normal, expensive) in self.nodes.items()
+            },
+            'edges': [
+                {'source': source, 'target': target, 'normal': normal, 'expensive': expensive}
+                for (source, target), (normal, expensive) in self.edges.items()
+            ],
+        }
+
+    def write_json(self, output: TextIO) -> None:
+        import json
+        json.dump(self.to_dict(), output, indent=2)
+        output.write('\n')
+
+    def write_csv(self, output: TextIO) -> None:
+        import csv
+        writer = csv.writer(output)
+        writer.writerow(['type', 'source', 'target', 'normal', 'expensive'])
+        for item, (normal, expensive) in self.nodes.items():
+            writer.writerow(['node', item, '', normal, expensive])
+        for (source, target), (normal, expensive) in self.edges.items():
+            writer.writerow(['edge', source, target, normal, expensive])
+
+    def render(self, output: Optional[TextIO]=None, format: str='svg') -> None:
+        if output is None:
+            output = sys.stdout
+        lines: Iterable[str] = self.dot_lines()
+        if format == 'dot':
+            output.writelines(lines)
+        else:
+            run_dot(lines, output, format)
+
+
+def difference(normal: float, expensive: float) -> str:
+    if abs(expensive - normal) < 0.05:
+        return ''
+    if normal == 0.0:
+        return ' (expensive only)'
+    return ' ({:+.1f}, {:+.0%})'.format(expensive - normal, expensive / normal - 1)
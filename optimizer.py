@@ -0,0 +1,249 @@
+import concurrent.futures
+import itertools
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from calculate import Factory, Graph, RecipeSet, default_recipes, oil_processing_factory
+
+
+class Module:
+    def __init__(self, speed: float, productivity: float) -> None:
+        self.speed = speed
+        self.productivity = productivity
+
+
+class Machine:
+    def __init__(self, speed: float, slots: int, productivity_allowed: bool) -> None:
+        self.speed = speed
+        self.slots = slots
+        self.productivity_allowed = productivity_allowed
+
+
+modules: Dict[str, Module] = {
+    'speed module 1': Module(0.2, 0.0),
+    'speed module 2': Module(0.3, 0.0),
+    'speed module 3': Module(0.5, 0.0),
+    'productivity module 1': Module(-0.05, 0.04),
+    'productivity module 2': Module(-0.1, 0.06),
+    'productivity module 3': Module(-0.15, 0.1),
+}
+
+# The machines behind the factory types in calculate.factories.
+machines: Dict[str, Machine] = {
+    'assembling machine IM': Machine(1.25, 4, True),
+    'assembling machine final': Machine(1.25, 4, False),
+    'assembling machine speed': Machine(1.25, 4, False),
+    'furnace': Machine(2.0, 2, True),
+    'mining drill': Machine(0.5, 3, True),
+    'chemical plant': Machine(1.0, 3, True),
+    'rocket silo': Machine(1.0, 4, True),
+    # full research
+    'lab': Machine(3.5, 2, True),
+}
+
+Loadout = Tuple[str, ...]
+
+
+def loadout_factory(machine: Machine, loadout: Loadout) -> Factory:
+    speed = 1.0 + sum(modules[name].speed for name in loadout)
+    productivity = 1.0 + sum(modules[name].productivity for name in loadout)
+    # The speed penalty is capped at 80%.
+    return Factory(machine.speed * max(0.2, speed), productivity)
+
+
+def candidate_loadouts(
+        machine: Machine,
+        module_names: Sequence[str],
+        count_modules: bool) -> List[Loadout]:
+    # Every combination of modules for the slots, without the dominated ones:
+    # those that are not faster or more productive than another one and
+    # (if modules are counted) don't use fewer modules either.
+    allowed = [
+        name for name in module_names
+        if machine.productivity_allowed or modules[name].productivity == 0.0
+    ]
+    loadouts: List[Loadout] = []
+    for count in range(machine.slots + 1):
+        loadouts.extend(itertools.combinations_with_replacement(allowed, count))
+
+    def key(loadout: Loadout) -> Tuple[float, float, int]:
+        factory = loadout_factory(machine, loadout)
+        return (factory.speed, factory.productivity, len(loadout) if count_modules else 0)
+
+    keys = {loadout: key(loadout) for loadout in loadouts}
+    result: List[Loadout] = []
+    for loadout, (speed, productivity, used) in keys.items():
+        dominated = any(
+            other_speed >= speed and other_productivity >= productivity and other_used <= used
+            and (other_speed, other_productivity, other_used) != (speed, productivity, used)
+            for other_speed, other_productivity, other_used in keys.values())
+        if not dominated and all(keys[other] != keys[loadout] for other in result):
+            result.append(loadout)
+    return result
+
+
+Task = Tuple[Dict[str, float], bool, bool, Dict[str, Tuple[float, float]]]
+
+
+worker_recipes: Optional[RecipeSet] = None
+
+
+def _init_worker(recipes: RecipeSet) -> None:
+    global worker_recipes
+    worker_recipes = recipes
+
+
+def _evaluate_recipes(recipes: RecipeSet, task: Task) -> Dict[str, float]:
+    # Returns the number of buildings per factory type.
+    targets, expensive, oil_processing, overrides = task
+    graph = Graph(expensive, recipes.overlay(factories={
+        factory_type: Factory(speed, productivity)
+        for factory_type, (speed, productivity) in overrides.items()
+    }))
+    if oil_processing:
+        graph.add_oil_processing()
+    for item, rate in targets.items():
+        graph.add(item, rate)
+
+    result: Dict[str, float] = {}
+    for name, buildings in graph.nodes.items():
+        if name in graph.oil_nodes and name != 'crude oil':
+            factory_type = oil_processing_factory
+        elif name in graph.recipes.products:
+            factory_type = graph.recipes.products[name].factory_type
+        else:
+            continue
+        if factory_type != 'raw':
+            result[factory_type] = result.get(factory_type, 0.0) + buildings
+    return result
+
+
+def _evaluate(task: Task) -> Dict[str, float]:
+    assert worker_recipes is not None
+    return _evaluate_recipes(worker_recipes, task)
+
+
+class Optimization:
+    def __init__(
+            self,
+            loadouts: Dict[str, Loadout],
+            factories: Dict[str, Factory],
+            buildings: Dict[str, float]) -> None:
+        self.loadouts = loadouts
+        self.factories = factories
+        self.buildings = buildings
+        self.total_buildings = sum(buildings.values())
+        self.total_modules = sum(
+            count * len(loadouts.get(factory_type, ()))
+            for factory_type, count in buildings.items())
+
+
+class ModuleOptimizer:
+    # Searches the module loadout of every factory type used by the targets.
+    # Small search spaces are enumerated completely, larger ones are searched
+    # by repeatedly applying the best single factory type change. Candidates
+    # are evaluated in a process pool.
+    def __init__(
+            self,
+            targets: Dict[str, float],
+            expensive: bool,
+            oil_processing: bool=True,
+            module_names: Iterable[str]=('speed module 3', 'productivity module 3'),
+            objective: str='buildings',
+            max_buildings: Optional[float]=None,
+            exhaustive_limit: int=2000,
+            max_workers: Optional[int]=None,
+            recipes: Optional[RecipeSet]=None) -> None:
+        if objective not in ('buildings', 'modules'):
+            raise RuntimeError('Unknown objective: {}'.format(objective))
+        self.targets = targets
+        self.expensive = expensive
+        self.oil_processing = oil_processing
+        self.module_names = list(module_names)
+        self.objective = objective
+        self.max_buildings = max_buildings
+        self.exhaustive_limit = exhaustive_limit
+        self.max_workers = max_workers
+        self.recipes = default_recipes() if recipes is None else recipes
+
+    def _task(self, loadouts: Dict[str, Loadout]) -> Task:
+        overrides = {}
+        for factory_type, loadout in loadouts.items():
+            factory = loadout_factory(machines[factory_type], loadout)
+            overrides[factory_type] = (factory.speed, factory.productivity)
+        return (self.targets, self.expensive, self.oil_processing, overrides)
+
+    def _result(self, loadouts: Dict[str, Loadout], buildings: Dict[str, float]) -> Optimization:
+        result_factories = dict(self.recipes.factories)
+        for factory_type, loadout in loadouts.items():
+            result_factories[factory_type] = loadout_factory(machines[factory_type], loadout)
+        return Optimization(dict(loadouts), result_factories, buildings)
+
+    def _score(self, result: Optimization) -> Tuple[bool, float, float]:
+        over_budget = self.max_buildings is not None and \
+            result.total_buildings > self.max_buildings
+        if self.objective == 'buildings':
+            return (over_budget, result.total_buildings, result.total_modules)
+        return (over_budget, result.total_modules, result.total_buildings)
+
+    def run(self) -> Optimization:
+        used = _evaluate_recipes(
+            self.recipes, (self.targets, self.expensive, self.oil_processing, {}))
+        candidates = {
+            factory_type: candidate_loadouts(
+                machines[factory_type], self.module_names, self.objective == 'modules')
+            for factory_type in sorted(used)
+            if factory_type in machines
+        }
+        factory_types = list(candidates)
+
+        workers = self.max_workers or os.cpu_count() or 1
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(self.recipes,)) as executor:
+
+            def evaluate_all(options: List[Dict[str, Loadout]]) -> List[Optimization]:
+                tasks = [self._task(loadouts) for loadouts in options]
+                chunksize = max(1, len(tasks) // (4 * workers))
+                return [
+                    self._result(loadouts, buildings)
+                    for loadouts, buildings in zip(
+                        options, executor.map(_evaluate, tasks, chunksize=chunksize))
+                ]
+
+            size = 1
+            for loadouts in candidates.values():
+                size *= len(loadouts)
+            if size <= self.exhaustive_limit:
+                options = [
+                    dict(zip(factory_types, combination))
+                    for combination in itertools.product(*candidates.values())
+                ]
+                return min(evaluate_all(options), key=self._score)
+
+            # Start from the most productive loadouts, which is usually close
+            # to the minimum building count.
+            current = {
+                factory_type: max(
+                    loadouts,
+                    key=lambda loadout: (
+                        loadout_factory(machines[factory_type], loadout).productivity,
+                        loadout_factory(machines[factory_type], loadout).speed))
+                for factory_type, loadouts in candidates.items()
+            }
+            best = evaluate_all([current])[0]
+            while True:
+                options = [
+                    {**current, factory_type: loadout}
+                    for factory_type, loadouts in candidates.items()
+                    for loadout in loadouts
+                    if loadout != current[factory_type]
+                ]
+                if not options:
+                    return best
+                result = min(evaluate_all(options), key=self._score)
+                if self._score(result) >= self._score(best):
+                    return best
+                best = result
+                current = result.loadouts
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import math
+import sys
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from calculate import Factory, Graph, RecipeSet, default_recipes
+
+# Requests are JSON objects:
+#   {"targets": {"science": 1}, "expensive": false, "oil_processing": true,
+#    "factories": {"furnace": [2, 1.2]}, "factory_types": {"solar panel": "furnace"},
+#    "format": "svg"}
+# Only targets is required, format only applies to /render.
+
+Query = Tuple[Tuple[Tuple[str, float], ...], bool, bool,
+              Tuple[Tuple[str, float, float], ...], Tuple[Tuple[str, str], ...]]
+
+
+def parse_query(recipes: RecipeSet, request: Dict[str, Any]) -> Query:
+    # Canonical form of a request, used as the cache key.
+    flags = []
+    for name, default in (('expensive', False), ('oil_processing', True)):
+        value = request.get(name, default)
+        if not isinstance(value, bool):
+            raise RuntimeError('{} must be true or false'.format(name))
+        flags.append(value)
+    try:
+        targets: Dict[str, float] = {}
+        for item, rate in request['targets'].items():
+            item = recipes.find_product(item)
+            targets[item] = targets.get(item, 0.0) + float(rate)
+        factories = tuple(sorted(
+            (factory_type, float(speed), float(productivity))
+            for factory_type, (speed, productivity) in request.get('factories', {}).items()))
+        factory_types = tuple(sorted(
+            (recipes.find_product(item), str(factory_type))
+            for item, factory_type in request.get('factory_types', {}).items()))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise RuntimeError('Invalid request')
+    for item, rate in targets.items():
+        if not (math.isfinite(rate) and rate >= 0):
+            raise RuntimeError('Rate of {} must be a finite number of at least 0'.format(item))
+    for factory_type, speed, productivity in factories:
+        if factory_type not in recipes.factories:
+            raise RuntimeError('Unknown factory type: {}'.format(factory_type))
+        if not (math.isfinite(speed) and speed > 0 and
+                math.isfinite(productivity) and productivity > 0):
+            raise RuntimeError(
+                'Speed and productivity of {} must be positive finite numbers'.format(
+                    factory_type))
+    for _, factory_type in factory_types:
+        if factory_type not in recipes.factories:
+            raise RuntimeError('Unknown factory type: {}'.format(factory_type))
+    return (
+        tuple(sorted(targets.items())),
+        flags[0],
+        flags[1],
+        factories,
+        factory_types)
+
+
+def solve(recipes: RecipeSet, query: Query) -> Graph:
+    targets, expensive, oil_processing, factories, factory_types = query
+    if factories or factory_types:
+        recipes = recipes.overlay(
+            factories={
+                factory_type: Factory(speed, productivity)
+                for factory_type, speed, productivity in factories
+            },
+            factory_types=dict(factory_types))
+    graph = Graph(expensive, recipes)
+    if oil_processing:
+        graph.add_oil_processing()
+    for item, rate in targets:
+        graph.add(item, rate)
+    # Tiny speeds or productivities can still overflow, which JSON can't
+    # represent.
+    if not all(math.isfinite(rate) for rate in graph.nodes.values()) or \
+            not all(math.isfinite(rate) for rate in graph.edges.values()):
+        raise RuntimeError('Rates are too large')
+    return graph
+
+
+worker_recipes: Optional[RecipeSet] = None
+
+
+def _init_worker(recipes: RecipeSet) -> None:
+    global worker_recipes
+    worker_recipes = recipes
+
+
+def _render(query: Query, format: str) -> str:
+    # Runs in the render pool, which has its own copy of the recipes.
+    assert worker_recipes is not None
+    output = io.StringIO()
+    solve(worker_recipes, query).render(output, format)
+    return output.getvalue()
+
+
+class PlannerDaemon:
+    # Keeps the recipes, their unit costs and recently solved graphs in
+    # memory and answers solve requests on the event loop. Rendering runs
+    # graphviz, which can take seconds for large graphs, so it is done in a
+    # process pool and quick numeric requests are not blocked by it.
+    def __init__(
+            self,
+            recipes: Optional[RecipeSet]=None,
+            cache_size: int=256,
+            render_workers: Optional[int]=None) -> None:
+        self.recipes = default_recipes() if recipes is None else recipes
+        self.cache_size = cache_size
+        self.cache: 'collections.OrderedDict[Tuple[Any, ...], Any]' = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.render_workers = render_workers
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def _cached(self, key: Tuple[Any, ...]) -> Any:
+        result = self.cache.get(key)
+        if result is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return result
+
+    def _store(self, key: Tuple[Any, ...], result: Any) -> None:
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def solve(self, request: Dict[str, Any]) -> Dict[str, object]:
+        query = parse_query(self.recipes, request)
+        key = ('solve', query)
+        result = self._cached(key)
+        if result is None:
+            result = solve(self.recipes, query).to_dict()
+            self._store(key, result)
+        return result
+
+    async def render(self, request: Dict[str, Any]) -> str:
+        query = parse_query(self.recipes, request)
+        format = str(request.get('format', 'svg'))
+        key = ('render', query, format)
+        result = self._cached(key)
+        if result is None:
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.render_workers,
+                    initializer=_init_worker,
+                    initargs=(self.recipes,))
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _render, query, format)
+            self._store(key, result)
+        return result
+
+    def status(self) -> Dict[str, object]:
+        return {
+            'cached': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'products': len(self.recipes.products),
+        }
+
+    async def handle(self, method: str, path: str, body: bytes) -> Tuple[int, str, str]:
+        # Returns the status code, content type and body of the response.
+        if method == 'GET' and path == '/status':
+            return (200, 'application/json', json.dumps(self.status()))
+        if method != 'POST' or path not in ('/solve', '/render'):
+            return (404, 'application/json', json.dumps({'error': 'Not found'}))
+        try:
+            request = json.loads(body or b'{}')
+            if not isinstance(request, dict):
+                raise RuntimeError('Invalid request')
+            if path == '/solve':
+                return (200, 'application/json', json.dumps(self.solve(request)))
+            format = str(request.get('format', 'svg'))
+            content_type = 'image/svg+xml' if format == 'svg' else 'text/plain'
+            return (200, content_type, await self.render(request))
+        except (RuntimeError, ValueError) as e:
+            return (400, 'application/json', json.dumps({'error': str(e)}))
+
+    async def serve_connection(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Minimal HTTP/1.1 with keep-alive, enough for a local client.
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                method, path, _ = parts
+                headers: Dict[str, str] = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+
+                status, content_type, content = await self.handle(method, path, body)
+                data = content.encode('utf-8')
+                writer.write(
+                    'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                        status, {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}[status],
+                        content_type, len(data)).encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(
+            self,
+            host: str='127.0.0.1',
+            port: int=8765,
+            unix_socket: Optional[str]=None) -> None:
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.serve_connection, unix_socket)
+        else:
+            server = await asyncio.start_server(self.serve_connection, host, port)
+        # Computing the unit costs of every product up front makes the first
+        # requests as fast as the later ones.
+        # A recipe cycle without net output is reported when it's requested.
+        for expensive in (False, True):
+            try:
+                self.recipes.costs(expensive).build()
+            except RuntimeError:
+                pass
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Serve solve and render requests over HTTP with the recipes kept in memory.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on (default: 8765)')
+    parser.add_argument('--unix-socket', help='listen on a Unix socket instead of TCP')
+    parser.add_argument(
+        '--cache-size', type=int, default=256, help='solved requests to keep (default: 256)')
+    parser.add_argument(
+        '--render-workers', type=int, help='processes running graphviz (default: CPU count)')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    daemon = PlannerDaemon(recipes, args.cache_size, args.render_workers)
+    try:
+        asyncio.run(daemon.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
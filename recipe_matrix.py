@@ -0,0 +1,153 @@
+import numpy
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from calculate import (
+    OilProcessing, RecipeSet, cycle_matrix, default_recipes, get_recipe, oil_processing_factory,
+    oil_products)
+
+
+class RecipeMatrix:
+    # Sparse column form of the recipe matrix: for every product, the indices
+    # of its inputs and the input rate needed per unit of output. Products are
+    # stored in topological order of their strongly connected components, so
+    # the matrix is block triangular and demand can be solved by forward
+    # substitution. The diagonal blocks of recipe cycles are inverted once.
+    # With oil_processing, the oil products of every scenario are balanced
+    # after the solve the same way Graph.add_oil_processing does.
+    def __init__(self, expensive: bool, recipes: Optional[RecipeSet]=None) -> None:
+        self.expensive = expensive
+        self.recipes = default_recipes() if recipes is None else recipes
+        products = self.recipes.products
+        factories = self.recipes.factories
+        structure = self.recipes.structure(expensive)
+        components = structure.components
+        self.names = [name for component in components for name in component]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        # The inverse is None for a cycle without net output, which is only
+        # an error for scenarios that need it.
+        self.cycles: Dict[int, Tuple[numpy.ndarray, Optional[numpy.ndarray]]] = {}
+        component_of: Dict[str, int] = {}
+        start = 0
+        for i, component in enumerate(components):
+            component_of.update((name, i) for name in component)
+            if structure.cycles[i]:
+                block = numpy.arange(start, start + len(component))
+                try:
+                    inverse: Optional[numpy.ndarray] = numpy.linalg.inv(numpy.array(
+                        cycle_matrix(products, factories, component, expensive)))
+                except numpy.linalg.LinAlgError:
+                    inverse = None
+                self.cycles[start] = (block, inverse)
+            start += len(component)
+
+        size = len(self.names)
+        self.buildings = numpy.zeros(size)
+        self.columns: List[Tuple[numpy.ndarray, numpy.ndarray]] = []
+        edge_sources: List[int] = []
+        edge_targets: List[int] = []
+        edge_amounts: List[float] = []
+
+        for j, name in enumerate(self.names):
+            product = products[name]
+            factory = factories[product.factory_type]
+            time, inputs = get_recipe(product, expensive)
+            self.buildings[j] = time / factory.speed / factory.productivity / product.product
+
+            indices = [self.index[input] for input in inputs]
+            amounts = [amount / factory.productivity / product.product for amount in inputs.values()]
+            # Demand inside a cycle is handled by the inverted block.
+            external = [
+                k for k, input in enumerate(inputs)
+                if component_of[input] != component_of[name]
+            ]
+            self.columns.append((
+                numpy.array([indices[k] for k in external], dtype=numpy.intp),
+                numpy.array([amounts[k] for k in external], dtype=numpy.float64)))
+            edge_sources.extend(indices)
+            edge_targets.extend([j] * len(indices))
+            edge_amounts.extend(amounts)
+
+        self.edge_sources = numpy.array(edge_sources, dtype=numpy.intp)
+        self.edge_targets = numpy.array(edge_targets, dtype=numpy.intp)
+        self.edge_amounts = numpy.array(edge_amounts, dtype=numpy.float64)
+
+    def target_matrix(self, scenarios: Sequence[Dict[str, float]]) -> numpy.ndarray:
+        targets = numpy.zeros((len(self.names), len(scenarios)))
+        for k, scenario in enumerate(scenarios):
+            for item, rate in scenario.items():
+                targets[self.index[self.recipes.find_product(item)], k] += rate
+        return targets
+
+    def solve(self, targets: numpy.ndarray, oil_processing: bool=False) -> 'Solution':
+        demand = numpy.array(targets, dtype=numpy.float64)
+        for j, (indices, amounts) in enumerate(self.columns):
+            if j in self.cycles:
+                block, inverse = self.cycles[j]
+                if inverse is not None:
+                    demand[block] = inverse @ demand[block]
+                if numpy.any(demand[block] < -1e-9) or \
+                        (inverse is None and numpy.any(demand[block] != 0)):
+                    raise RuntimeError('Recipe cycle has no net output: {}'.format(
+                        ', '.join(self.names[k] for k in block)))
+            if len(indices) != 0:
+                demand[indices] += numpy.outer(amounts, demand[j])
+        return Solution(self, targets, demand, oil_processing)
+
+    def solve_all(
+            self,
+            scenarios: Sequence[Dict[str, float]],
+            oil_processing: bool=False) -> 'Solution':
+        return self.solve(self.target_matrix(scenarios), oil_processing)
+
+
+class Solution:
+    # Every array has one column per scenario.
+    def __init__(
+            self,
+            matrix: RecipeMatrix,
+            targets: numpy.ndarray,
+            demand: numpy.ndarray,
+            oil_processing: bool=False) -> None:
+        self.matrix = matrix
+        self.targets = targets
+        self.demand = demand
+        self.buildings = demand * matrix.buildings[:, numpy.newaxis]
+        self.edge_rates = demand[matrix.edge_targets] * matrix.edge_amounts[:, numpy.newaxis]
+        # Oil processing is balanced after the solve from the total oil
+        # demand of each scenario, as Graph.add_oil_processing does.
+        self.oil: List[Tuple[Dict[str, float], Dict[Tuple[str, str], float]]] = []
+        if oil_processing:
+            processing = OilProcessing.for_factory(matrix.recipes.factories[oil_processing_factory])
+            for k in range(demand.shape[1]):
+                rates = [
+                    float(demand[matrix.index[name], k]) if name in matrix.index else 0.0
+                    for name in oil_products
+                ]
+                self.oil.append(processing.balance(*rates))
+
+    # The same layout as Graph.nodes, but items that are not needed by the
+    # scenario are left out.
+    def nodes(self, scenario: int) -> Dict[str, float]:
+        names = self.matrix.names
+        result = {'end': 0.0}
+        for j in numpy.flatnonzero(self.demand[:, scenario]):
+            result[names[j]] = float(self.buildings[j, scenario])
+        if self.oil:
+            for name, rate in self.oil[scenario][0].items():
+                result[name] = result.get(name, 0.0) + rate
+        return result
+
+    # The same layout as Graph.edges.
+    def edges(self, scenario: int) -> Dict[Tuple[str, str], float]:
+        names = self.matrix.names
+        result: Dict[Tuple[str, str], float] = {}
+        for j in numpy.flatnonzero(self.targets[:, scenario]):
+            result[(names[j], 'end')] = float(self.targets[j, scenario])
+        rates = self.edge_rates[:, scenario]
+        for e in numpy.flatnonzero(rates):
+            source = names[self.matrix.edge_sources[e]]
+            target = names[self.matrix.edge_targets[e]]
+            result[(source, target)] = float(rates[e])
+        if self.oil:
+            result.update(self.oil[scenario][1])
+        return result
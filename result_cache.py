@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from calculate import RecipeSet
+
+# Output formats that are text and can be stored as they are.
+text_formats = ('json', 'csv', 'dot', 'svg', 'xdot', 'plain', 'plain-ext')
+
+
+def recipe_set_digest(recipes: RecipeSet) -> str:
+    # Everything about the recipes and factories that affects a result,
+    # including the colors and categories used when rendering.
+    digest = hashlib.sha256()
+    for name in sorted(recipes.products):
+        product = recipes.products[name]
+        digest.update(json.dumps([
+            name, product.time, product.product, sorted(product.inputs.items()),
+            product.time_expensive, sorted((product.input_expensive or {}).items()),
+            product.factory_type, product.color, product.category,
+        ]).encode('utf-8'))
+    for name in sorted(recipes.factories):
+        factory = recipes.factories[name]
+        digest.update(json.dumps([name, factory.speed, factory.productivity]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def scenario_key(
+        recipes: RecipeSet,
+        expensive: bool,
+        oil_processing: bool,
+        targets: Sequence[Tuple[str, float]]) -> str:
+    # Targets are summed per item, so the order they are given in doesn't
+    # matter.
+    rates: Dict[str, float] = {}
+    for item, rate in targets:
+        rates[item] = rates.get(item, 0.0) + rate
+    return hashlib.sha256(json.dumps([
+        recipe_set_digest(recipes), expensive, oil_processing, sorted(rates.items()),
+    ]).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    # Outputs of solved scenarios stored in a directory by scenario key and
+    # format. The least recently used files are removed when the directory
+    # grows over max_bytes; every hit updates the modification time.
+    def __init__(self, directory: str, max_bytes: int=256 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str, format: str) -> str:
+        return os.path.join(self.directory, key[:2], '{}.{}'.format(key, format))
+
+    def get(self, key: str, format: str) -> Optional[str]:
+        path = self._path(key, format)
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                content = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return content
+
+    def put(self, key: str, format: str, content: str) -> None:
+        path = self._path(key, format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import numpy
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from calculate import (
+    OilProcessing, RecipeSet, cycle_matrix, default_recipes, get_recipe, oil_processing_factory,
+    oil_products, parse_target)
+
+Number = Union['Dual', float]
+
+
+class Dual:
+    # Forward-mode dual number: a value and its derivatives with respect to
+    # every parameter at once.
+    __slots__ = ('value', 'tangent')
+
+    def __init__(self, value: float, tangent: numpy.ndarray) -> None:
+        self.value = value
+        self.tangent = tangent
+
+    def __add__(self, other: Number) -> 'Dual':
+        if isinstance(other, Dual):
+            return Dual(self.value + other.value, self.tangent + other.tangent)
+        return Dual(self.value + other, self.tangent)
+
+    __radd__ = __add__
+
+    def __neg__(self) -> 'Dual':
+        return Dual(-self.value, -self.tangent)
+
+    def __sub__(self, other: Number) -> 'Dual':
+        return self + -other
+
+    def __rsub__(self, other: float) -> 'Dual':
+        return -self + other
+
+    def __mul__(self, other: Number) -> 'Dual':
+        if isinstance(other, Dual):
+            return Dual(
+                self.value * other.value,
+                self.tangent * other.value + other.tangent * self.value)
+        return Dual(self.value * other, self.tangent * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other: Number) -> 'Dual':
+        if isinstance(other, Dual):
+            return Dual(
+                self.value / other.value,
+                (self.tangent * other.value - other.tangent * self.value) / other.value ** 2)
+        return Dual(self.value / other, self.tangent / other)
+
+    def __rtruediv__(self, other: float) -> 'Dual':
+        return Dual(other / self.value, self.tangent * (-other / self.value ** 2))
+
+    def __lt__(self, other: Number) -> bool:
+        return self.value < (other.value if isinstance(other, Dual) else other)
+
+    def __gt__(self, other: Number) -> bool:
+        return self.value > (other.value if isinstance(other, Dual) else other)
+
+
+class Sensitivity:
+    # Total buildings and raw inputs of the targets together with their
+    # derivatives with respect to the speed and productivity of every
+    # factory type, from one propagation of dual numbers through the recipe
+    # graph. Buildings of raw resources ('raw' factory type) are not counted.
+    def __init__(
+            self,
+            targets: Dict[str, float],
+            expensive: bool,
+            oil_processing: bool=True,
+            recipes: Optional[RecipeSet]=None) -> None:
+        self.recipes = default_recipes() if recipes is None else recipes
+        self.expensive = expensive
+        self.factory_types = list(self.recipes.factories)
+        size = 2 * len(self.factory_types)
+        self.zero = numpy.zeros(size)
+
+        # Tangent 2k is the speed and 2k + 1 the productivity of factory k.
+        self.factories: Dict[str, Tuple[Dual, Dual]] = {}
+        for k, factory_type in enumerate(self.factory_types):
+            factory = self.recipes.factories[factory_type]
+            self.factories[factory_type] = (
+                Dual(factory.speed, numpy.eye(size)[2 * k]),
+                Dual(factory.productivity, numpy.eye(size)[2 * k + 1]))
+
+        self.buildings = Dual(0.0, self.zero)
+        self.raw: Dict[str, Dual] = {}
+        self._solve(targets, oil_processing)
+
+    def _solve(self, targets: Dict[str, float], oil_processing: bool) -> None:
+        products = self.recipes.products
+        structure = self.recipes.structure(self.expensive)
+        pending: Dict[str, Dual] = {}
+        for item, target_rate in targets.items():
+            item = self.recipes.find_product(item)
+            pending[item] = pending.get(item, Dual(0.0, self.zero)) + target_rate
+
+        first = min(
+            (structure.component_of[structure.ids[item]] for item in pending),
+            default=len(structure.components))
+        for c in range(first, len(structure.components)):
+            component = structure.components[c]
+            if not any(name in pending for name in component):
+                continue
+            demand = [pending.pop(name, Dual(0.0, self.zero)) for name in component]
+            if structure.cycles[c]:
+                demand = self._solve_cycle(component, demand)
+
+            for name, rate in zip(component, demand):
+                product = products[name]
+                speed, productivity = self.factories[product.factory_type]
+                time, inputs = get_recipe(product, self.expensive)
+                if not inputs:
+                    self.raw[name] = self.raw.get(name, Dual(0.0, self.zero)) + rate
+                if product.factory_type != 'raw':
+                    self.buildings += rate * time / (speed * productivity * product.product)
+                input_rate = rate / (productivity * product.product)
+                for input, amount in inputs.items():
+                    if input not in component:
+                        pending[input] = pending.get(input, Dual(0.0, self.zero)) + \
+                            input_rate * amount
+        if oil_processing:
+            self._solve_oil()
+
+    def _solve_cycle(self, component: List[str], demand: List[Dual]) -> List[Dual]:
+        # x = M^-1 r and dx = M^-1 (dr - dM x), where only the productivity
+        # of the consumer changes M.
+        products = self.recipes.products
+        matrix = numpy.array(cycle_matrix(
+            products, self.recipes.factories, component, self.expensive))
+        try:
+            values = numpy.linalg.solve(matrix, [rate.value for rate in demand])
+        except numpy.linalg.LinAlgError:
+            values = None
+        if values is None or numpy.any(values < -1e-9):
+            raise RuntimeError('Recipe cycle has no net output: {}'.format(', '.join(component)))
+        tangents = numpy.array([rate.tangent for rate in demand])
+        for j, name in enumerate(component):
+            productivity = self.factories[products[name].factory_type][1]
+            # dM[i][j] / d(productivity) = A[i][j] / productivity
+            column = (numpy.identity(len(component))[:, j] - matrix[:, j]) / productivity.value
+            tangents -= numpy.outer(column * values[j], productivity.tangent)
+        tangents = numpy.linalg.solve(matrix, tangents)
+        return [Dual(float(value), tangent) for value, tangent in zip(values, tangents)]
+
+    def _solve_oil(self) -> None:
+        # OilProcessing is generic over the number type, so it runs on dual
+        # numbers as it is.
+        speed, productivity = self.factories[oil_processing_factory]
+        processing = OilProcessing(speed, productivity)
+        heavy, light, gas = (self.raw.pop(name, Dual(0.0, self.zero)) for name in oil_products)
+        crude_oil, heavy_cracked, light_cracked = processing.solve(heavy, light, gas)
+        self.raw['crude oil'] = self.raw.get('crude oil', Dual(0.0, self.zero)) + crude_oil
+        self.buildings += (
+            crude_oil * processing.refinery +
+            heavy_cracked * processing.heavy_oil_cracking +
+            light_cracked * processing.light_oil_cracking)
+
+    def buildings_by_speed(self) -> Dict[str, float]:
+        # d(total buildings) / d(speed) per factory type.
+        return {
+            factory_type: float(self.buildings.tangent[2 * k])
+            for k, factory_type in enumerate(self.factory_types)
+        }
+
+    def buildings_by_productivity(self) -> Dict[str, float]:
+        return {
+            factory_type: float(self.buildings.tangent[2 * k + 1])
+            for k, factory_type in enumerate(self.factory_types)
+        }
+
+    def raw_by_productivity(self) -> Dict[str, Dict[str, float]]:
+        # d(raw input rate) / d(productivity) per factory type and raw input.
+        return {
+            factory_type: {name: float(rate.tangent[2 * k + 1]) for name, rate in self.raw.items()}
+            for k, factory_type in enumerate(self.factory_types)
+        }
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Show how buildings and raw inputs change with factory speed and productivity.')
+    parser.add_argument(
+        'targets', nargs='+', metavar='ITEM=RATE', help='item and its rate per second')
+    parser.add_argument(
+        '-e', '--expensive', action='store_true', help='use expensive recipes')
+    parser.add_argument(
+        '--no-oil-processing', action='store_true', help='leave oil products as raw inputs')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        targets: Dict[str, float] = {}
+        for text in args.targets:
+            item, rate = parse_target(recipes, text, args.expensive)
+            targets[item] = targets.get(item, 0.0) + rate
+        sensitivity = Sensitivity(targets, args.expensive, not args.no_oil_processing, recipes)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    print('total buildings: {:.2f}'.format(sensitivity.buildings.value))
+    by_speed = sensitivity.buildings_by_speed()
+    by_productivity = sensitivity.buildings_by_productivity()
+    raw_by_productivity = sensitivity.raw_by_productivity()
+    print('{:<26} {:>14} {:>14}  {}'.format(
+        'factory type', 'dB/dspeed', 'dB/dprod', 'd(raw)/dprod'))
+    for factory_type in sensitivity.factory_types:
+        raw = ', '.join(
+            '{} {:.2f}'.format(name, rate)
+            for name, rate in sorted(raw_by_productivity[factory_type].items())
+            if abs(rate) > 1e-9)
+        print('{:<26} {:>14.2f} {:>14.2f}  {}'.format(
+            factory_type, by_speed[factory_type], by_productivity[factory_type], raw))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+import heapq
+import math
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from calculate import (
+    Graph, get_recipe, oil_processing_factory, oil_products, oil_recipes, parse_target)
+
+
+class Edge:
+    # Items of source waiting to be used by target.
+    __slots__ = ('source', 'target', 'item', 'share', 'amount', 'capacity', 'items')
+
+    def __init__(self, source: str, target: str, item: str, share: float, amount: float) -> None:
+        self.source = source
+        self.target = target
+        self.item = item
+        # Part of the item made by source that goes to this edge.
+        self.share = share
+        # Items used per craft of target.
+        self.amount = amount
+        self.capacity = 0.0
+        self.items = 0.0
+
+
+class Machines:
+    # All machines of one recipe. They work in lockstep cycles of one or
+    # more crafts, so there is one event per recipe and cycle however many
+    # machines there are.
+    __slots__ = (
+        'name', 'count', 'craft_time', 'cycle', 'capacity', 'products', 'inputs', 'outputs',
+        'stock', 'source_rate', 'tank', 'running', 'crafts', 'starved_time', 'blocked_time',
+        'down')
+
+    def __init__(
+            self,
+            name: str,
+            count: int,
+            craft_time: float,
+            products: Dict[str, float],
+            step: float) -> None:
+        self.name = name
+        self.count = count
+        self.craft_time = craft_time
+        crafts = max(1, round(step / craft_time))
+        self.cycle = crafts * craft_time
+        # Crafts per cycle with every machine busy.
+        self.capacity = crafts * count
+        # Items of every output per craft.
+        self.products = products
+        self.inputs: List[Edge] = []
+        self.outputs: Dict[str, List[Edge]] = {item: [] for item in products}
+        # Finished items that did not fit into the output edges.
+        self.stock = {item: 0.0 for item in products}
+        # Raw resources are supplied at a fixed rate instead of crafted.
+        self.source_rate: Optional[float] = None
+        # Oil products pass on whatever oil processing delivers.
+        self.tank = False
+        self.running = 0
+        self.crafts = 0
+        self.starved_time = 0.0
+        self.blocked_time = 0.0
+        self.down = 0
+
+
+class SimulationResult:
+    def __init__(self, simulator: 'Simulator', duration: float) -> None:
+        self.duration = duration
+        crafting = [group for group in simulator.groups.values() if group.count]
+        self.machines = {group.name: group.count for group in crafting}
+        self.delivered = dict(simulator.delivered)
+        self.throughput = simulator.samples
+        self.utilization = {
+            group.name: group.crafts * group.craft_time / (group.count * duration)
+            for group in crafting if duration
+        }
+        # Seconds all machines of a recipe would have been idle for.
+        self.starved = {group.name: group.starved_time for group in crafting}
+        self.blocked = {group.name: group.blocked_time for group in crafting}
+        self.buffers = {
+            (edge.source, edge.target): edge.items for edge in simulator.edges
+        }
+
+
+class Simulator:
+    # Discrete-event simulation of a solved Graph with whole machines: the
+    # building count of every recipe rounded up. Every recipe edge has a
+    # buffer. Each recipe runs in cycles of about step seconds; at the end
+    # of a cycle its output goes into the buffers of its consumers and as
+    # many crafts start as there are idle machines, inputs and room for the
+    # output. Events are kept in a heap, so quiet parts of the factory cost
+    # nothing between their cycles. Raw resources ('raw' factory type
+    # without inputs) arrive at their steady-state rate and targets are
+    # taken away as soon as they are made. With oil processing, refineries
+    # and crackers are machines too and the oil products are tanks between
+    # them and their consumers. Outages stop a recipe or resource for a
+    # while to see how the factory recovers.
+    def __init__(
+            self,
+            graph: Graph,
+            buffer_seconds: float=10.0,
+            step: float=1.0,
+            sample_interval: float=60.0,
+            outages: Sequence[Tuple[str, float, float]]=()) -> None:
+        self.graph = graph
+        self.sample_interval = sample_interval
+        products = graph.recipes.products
+        factories = graph.recipes.factories
+        oil_processing = graph.oil_processing is not None
+
+        supply = {name: rate for name, rate in graph.demand.items() if rate > 1e-12}
+        if 'crude oil' in graph.oil_nodes:
+            supply['crude oil'] = supply.get('crude oil', 0.0) + graph.oil_nodes['crude oil']
+        self.groups: Dict[str, Machines] = {}
+        for name, rate in supply.items():
+            if oil_processing and name in oil_products:
+                self._add_tank(name, step)
+                continue
+            product = products[name]
+            factory = factories[product.factory_type]
+            time, inputs = get_recipe(product, graph.expensive)
+            if product.factory_type == 'raw' and not inputs:
+                group = Machines(name, 0, step, {name: rate * step}, step)
+                group.source_rate = rate
+            else:
+                group = Machines(
+                    name,
+                    max(1, math.ceil(graph.nodes[name] - 1e-9)),
+                    time / factory.speed,
+                    {name: product.product * factory.productivity},
+                    step)
+            self.groups[name] = group
+        factory = factories[oil_processing_factory]
+        for name, recipe in oil_recipes.items():
+            if name in graph.oil_nodes:
+                self.groups[name] = Machines(
+                    name,
+                    max(1, math.ceil(graph.oil_nodes[name] - 1e-9)),
+                    recipe.time / factory.speed,
+                    {item: amount * factory.productivity for item, amount in recipe.outputs.items()},
+                    step)
+        for _, target in graph.oil_edges:
+            item = oil_recipes[target].input if target in oil_recipes else target
+            if item in oil_products and item not in self.groups:
+                self._add_tank(item, step)
+
+        # Edges start with their rate as share.
+        self.edges: List[Edge] = []
+        for name, group in self.groups.items():
+            if group.source_rate is not None or group.tank or name in oil_recipes:
+                continue
+            for input, amount in get_recipe(products[name], graph.expensive)[1].items():
+                rate = graph.edges.get((input, name), 0.0)
+                if input in self.groups and rate > 1e-12:
+                    self._add_edge(Edge(input, name, input, rate, amount))
+        # Every oil product goes through its tank, also on its way from the
+        # refinery to a cracker, so that each consumer has one input edge per
+        # item.
+        oil_edges: Dict[Tuple[str, str], float] = {}
+        for (source, target), rate in graph.oil_edges.items():
+            if target in oil_recipes and source != oil_recipes[target].input:
+                item = oil_recipes[target].input
+                oil_edges[(source, item)] = oil_edges.get((source, item), 0.0) + rate
+                oil_edges[(item, target)] = oil_edges.get((item, target), 0.0) + rate
+            else:
+                oil_edges[(source, target)] = oil_edges.get((source, target), 0.0) + rate
+        for (source, target), rate in oil_edges.items():
+            if target in oil_recipes:
+                self._add_edge(Edge(source, target, source, rate, oil_recipes[target].amount))
+            else:
+                self._add_edge(Edge(source, target, target, rate, 0.0))
+        # Oil products that nothing needs are thrown away, as in the steady
+        # state, instead of blocking the refinery.
+        for name in oil_recipes:
+            if name not in self.groups:
+                continue
+            group = self.groups[name]
+            for item in [item for item, edges in group.outputs.items() if not edges]:
+                del group.products[item], group.outputs[item], group.stock[item]
+
+        made = {
+            (name, name): graph.edges[(name, 'end')]
+            for name in graph.targets if name in self.groups
+        }
+        for edge in self.edges:
+            key = (edge.source, edge.item)
+            made[key] = made.get(key, 0.0) + edge.share
+        self.end_shares = {
+            name: graph.edges[(name, 'end')] / made[(name, name)]
+            for name in graph.targets if made.get((name, name), 0.0) > 1e-12
+        }
+        for edge in self.edges:
+            rate = edge.share
+            edge.share = rate / made[(edge.source, edge.item)]
+            producer = self.groups[edge.source]
+            # Room for at least two cycles of both ends.
+            edge.capacity = max(
+                rate * buffer_seconds,
+                2 * edge.amount * self.groups[edge.target].capacity,
+                2 * producer.products[edge.item] * producer.capacity * edge.share)
+
+        self.outages = []
+        for item, start, end in outages:
+            name = item if item in self.groups else graph.recipes.find_product(item)
+            if name not in self.groups:
+                raise RuntimeError('Outage of {}, which is not part of the factory'.format(item))
+            self.outages.append((name, start, end))
+
+        self.delivered = {name: 0.0 for name in sorted(graph.targets)}
+        self.samples: Dict[str, List[Tuple[float, float]]] = {name: [] for name in self.delivered}
+        self.events: List[Tuple[float, int, str, str]] = []
+        self.sequence = 0
+        self.now = 0.0
+
+    def _add_tank(self, name: str, step: float) -> None:
+        group = Machines(name, 0, step, {name: 0.0}, step)
+        group.tank = True
+        self.groups[name] = group
+
+    def _add_edge(self, edge: Edge) -> None:
+        self.groups[edge.target].inputs.append(edge)
+        self.groups[edge.source].outputs[edge.item].append(edge)
+        self.edges.append(edge)
+
+    def _schedule(self, time: float, kind: str, name: str) -> None:
+        self.sequence += 1
+        heapq.heappush(self.events, (time, self.sequence, kind, name))
+
+    def _deliver(self, group: Machines, item: str, items: float) -> None:
+        # Splits items over the targets and the output edges by their share
+        # of the steady-state flow. What doesn't fit goes to the edges that
+        # still have room, and the rest stays in stock.
+        share = self.end_shares.get(item, 0.0) if item == group.name else 0.0
+        if share:
+            self.delivered[item] += items * share
+        left = group.stock[item] + items * (1.0 - share)
+        outputs = group.outputs[item]
+        total_share = sum(edge.share for edge in outputs)
+        placed = 0.0
+        for edge in outputs:
+            part = min(left * edge.share / total_share, edge.capacity - edge.items)
+            edge.items += part
+            placed += part
+        left -= placed
+        for edge in outputs:
+            if left <= 1e-9:
+                break
+            part = min(left, edge.capacity - edge.items)
+            edge.items += part
+            left -= part
+        group.stock[item] = max(0.0, left)
+
+    def _cycle(self, group: Machines) -> None:
+        # Finishes the crafts of the last cycle and starts the next one.
+        if group.tank:
+            if not group.down:
+                items = sum(edge.items for edge in group.inputs)
+                for edge in group.inputs:
+                    edge.items = 0.0
+                self._deliver(group, group.name, items)
+            # A tank holds as much as the buffers of its inputs. Oil beyond
+            # that is lost, as the steady state throws away any surplus.
+            group.stock[group.name] = min(
+                group.stock[group.name], sum(edge.capacity for edge in group.inputs))
+            return
+        if group.source_rate is not None:
+            if not group.down:
+                self._deliver(group, group.name, group.products[group.name])
+            # Raw resources that can't be used right away are lost.
+            group.stock[group.name] = 0.0
+            return
+        group.crafts += group.running
+        for item, amount in group.products.items():
+            self._deliver(group, item, group.running * amount)
+        group.running = 0
+        if group.down:
+            return
+        if any(stock > 1e-9 for stock in group.stock.values()):
+            group.blocked_time += group.cycle
+            return
+        crafts = group.capacity
+        for edge in group.inputs:
+            crafts = min(crafts, math.floor(edge.items / edge.amount + 1e-9))
+        if crafts < group.capacity:
+            group.starved_time += group.cycle * (group.capacity - crafts) / group.capacity
+        for edge in group.inputs:
+            edge.items = max(0.0, edge.items - crafts * edge.amount)
+        group.running = crafts
+
+    def _sample(self, last_sample: Dict[str, float]) -> Dict[str, float]:
+        # Adds the throughput since last_sample and returns the new totals.
+        for target, samples in self.samples.items():
+            samples.append((
+                self.now,
+                (self.delivered[target] - last_sample[target]) / self.sample_interval))
+        return dict(self.delivered)
+
+    def run(self, duration: float) -> SimulationResult:
+        # Sources first, so their items are there when the others start.
+        for sources in (True, False):
+            for name, group in self.groups.items():
+                if (group.source_rate is not None) == sources:
+                    self._schedule(0.0, 'cycle', name)
+        for name, start, end in self.outages:
+            self._schedule(start, 'down', name)
+            self._schedule(end, 'up', name)
+        self._schedule(self.sample_interval, 'sample', '')
+        last_sample = dict(self.delivered)
+
+        # Events at duration itself are after the simulated time, so that
+        # every average is over exactly duration seconds.
+        while self.events and self.events[0][0] < duration:
+            self.now, _, kind, name = heapq.heappop(self.events)
+            if kind == 'cycle':
+                group = self.groups[name]
+                self._cycle(group)
+                self._schedule(self.now + group.cycle, 'cycle', name)
+            elif kind == 'down':
+                self.groups[name].down += 1
+            elif kind == 'up':
+                self.groups[name].down -= 1
+            elif kind == 'sample':
+                last_sample = self._sample(last_sample)
+                self._schedule(self.now + self.sample_interval, 'sample', '')
+        # Except for a sample that ends right at duration.
+        for time, _, kind, _ in self.events:
+            if kind == 'sample' and time <= duration:
+                self.now = time
+                self._sample(last_sample)
+        return SimulationResult(self, duration)
+
+
+def parse_outage(text: str) -> Tuple[str, float, float]:
+    # ITEM=START:END in seconds.
+    item, separator, interval = text.rpartition('=')
+    start, colon, end = interval.partition(':')
+    try:
+        if not separator or not colon:
+            raise ValueError
+        return (item.strip(), float(start), float(end))
+    except ValueError:
+        raise RuntimeError('Outage must be ITEM=START:END: {}'.format(text))
+
+
+def main(argv: Optional[Sequence[str]]=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Simulate a factory with whole machines and buffers over time.')
+    parser.add_argument(
+        'targets', nargs='+', metavar='ITEM=RATE', help='item and its rate per second')
+    parser.add_argument(
+        '-e', '--expensive', action='store_true', help='use expensive recipes')
+    parser.add_argument(
+        '--no-oil-processing', action='store_true', help='leave oil products as raw inputs')
+    parser.add_argument(
+        '-t', '--duration', type=float, default=3600.0,
+        help='simulated seconds (default: 3600)')
+    parser.add_argument(
+        '--buffer-seconds', type=float, default=10.0,
+        help='buffer size of every edge in seconds of steady-state flow (default: 10)')
+    parser.add_argument(
+        '--step', type=float, default=1.0,
+        help='approximate seconds between the events of a product (default: 1)')
+    parser.add_argument(
+        '--sample-interval', type=float, default=60.0,
+        help='seconds between throughput samples (default: 60)')
+    parser.add_argument(
+        '--outage', action='append', default=[], metavar='ITEM=START:END',
+        help='stop the production or supply of an item for a while')
+    parser.add_argument(
+        '--data-dump', help='load recipes from a Factorio data-raw-dump.json')
+    args = parser.parse_args(argv)
+
+    try:
+        from factorio_data import load_recipes
+        recipes = load_recipes(args.data_dump)
+        graph = Graph(args.expensive, recipes)
+        if not args.no_oil_processing:
+            graph.add_oil_processing()
+        for target in args.targets:
+            graph.add(*parse_target(recipes, target, args.expensive))
+        simulator = Simulator(
+            graph, args.buffer_seconds, args.step, args.sample_interval,
+            outages=[parse_outage(text) for text in args.outage])
+        result = simulator.run(args.duration)
+    except RuntimeError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    print('{} machines, {:.0f} s simulated'.format(sum(result.machines.values()), args.duration))
+    for target, samples in result.throughput.items():
+        steady = graph.edges[(target, 'end')]
+        print('{}: {:.4f}/s on average, {:.4f}/s steady state'.format(
+            target, result.delivered[target] / args.duration, steady))
+        print('  ' + ' '.join('{:.3f}'.format(rate) for _, rate in samples))
+    starved = sorted(
+        (item for item in result.starved.items() if item[1] > 0), key=lambda item: -item[1])
+    if starved:
+        print('most starved:')
+    for name, seconds in starved[:10]:
+        print('  {:<30} {:>8.0f} s, {} machines, {:.0%} busy'.format(
+                name, seconds, result.machines.get(name, 0), result.utilization.get(name, 0.0)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())